@@ -1,5 +1,190 @@
+import re
+import logging
+import threading
+
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from cassandra import UnsupportedOperation
 from cassandra.cluster import \
     Cluster, DCAwareRoundRobinPolicy
+from cassandra.policies import HostDistance, TokenAwarePolicy
+
+from cassandra_io import metrics, sqlite_backend
+
+
+# process-wide clusters and sessions shared by all instances
+_REGISTRY_LOCK = threading.Lock()
+_CLUSTERS = {}
+_SESSIONS = {}
+
+# table names in statements that are qualified with a keyspace
+_TABLE_NAME = re.compile\
+    (r'\b(FROM|INTO|UPDATE|TABLE(?:\s+IF\s+NOT\s+EXISTS)?)'
+     r'\s+(\w+)(?![\w.])', re.IGNORECASE)
+
+# statements are prepared concurrently, see Cassandra_Base._prepare
+_PREPARE_POOL = ThreadPoolExecutor(max_workers = 16)
+
+
+def _table_name(query):
+    return re.search(r'CREATE\s+TABLE\s+IF\s+NOT\s+EXISTS\s+(\w+)',
+                     query, re.IGNORECASE).group(1)
+
+
+def get_cluster(cluster_ips,
+                backend = 'cassandra',
+                connections_per_host = None,
+                max_requests_per_connection = None,
+                **kwargs):
+    """Get a cluster shared within the process
+
+    Clusters are created once per contact points and settings.
+
+    :cluster_ips: cluster ips
+
+    :backend: 'cassandra', or 'sqlite' for an in-process cluster
+    keeping tables in memory (see sqlite_backend.py). Instances with
+    the same cluster_ips share data.
+
+    :connections_per_host: number of connections per local host. Only
+    supported by protocol versions 1 and 2, later versions use one
+    connection per host.
+
+    :max_requests_per_connection: concurrent requests per connection
+    above which new connections are opened. Only supported by
+    protocol versions 1 and 2, otherwise both settings are ignored
+    with a warning and in-flight requests are not limited here.
+
+    Note, connection pools belong to sessions, which are shared per
+    cluster (see get_session). All instances on a cluster share a
+    pool, regardless of their keyspaces and timeouts.
+
+    :kwargs: arguments passed to Cluster
+
+    """
+    key = (tuple(sorted(cluster_ips)), backend, connections_per_host,
+           max_requests_per_connection, repr(sorted(kwargs.items())))
+
+    with _REGISTRY_LOCK:
+        if key in _CLUSTERS:
+            return _CLUSTERS[key]
+
+        if backend == 'sqlite':
+            _CLUSTERS[key] = sqlite_backend.Cluster()
+            return _CLUSTERS[key]
+        if backend != 'cassandra':
+            raise RuntimeError("unknown backend: %s" % backend)
+
+        cluster = Cluster\
+            (contact_points=list(cluster_ips),
+             load_balancing_policy=TokenAwarePolicy\
+             (DCAwareRoundRobinPolicy(local_dc='datacenter1')),
+             **kwargs)
+
+        try:
+            if connections_per_host is not None:
+                cluster.set_core_connections_per_host\
+                    (HostDistance.LOCAL, connections_per_host)
+                cluster.set_max_connections_per_host\
+                    (HostDistance.LOCAL, connections_per_host)
+            if max_requests_per_connection is not None:
+                cluster.set_max_requests_per_connection\
+                    (HostDistance.LOCAL, max_requests_per_connection)
+        except UnsupportedOperation as e:
+            logging.warning("get_cluster: %s" % str(e))
+
+        _CLUSTERS[key] = cluster
+        return cluster
+
+
+def get_session(cluster):
+    """Get a session shared within the process
+
+    Sessions are created once per cluster and have no keyspace, so
+    that all instances share connection pools (see Keyspace_Session).
+
+    :cluster: a cluster from get_cluster
+
+    """
+    with _REGISTRY_LOCK:
+        if id(cluster) in _SESSIONS:
+            return _SESSIONS[id(cluster)][1]
+
+        session = cluster.connect()
+        session.add_request_init_listener(metrics.request_listener)
+        # cluster is kept, so that its id is not reused
+        _SESSIONS[id(cluster)] = (cluster, session)
+        return session
+
+
+class Keyspace_Session:
+    """Statements of a keyspace on a shared session
+
+    Table names in query strings, after FROM, INTO, UPDATE and
+    TABLE, are qualified with the keyspace. Requests get the
+    timeout of the instance. Other attributes are the ones of the
+    session.
+
+    """
+
+    def __init__(self, session, keyspace, timeout = None):
+        """
+        :session: a session from get_session
+
+        :keyspace: keyspace of tables in statements
+
+        :timeout: timeout of requests, None keeps the driver default
+
+        """
+        self._session = session
+        self._keyspace = keyspace
+        self._timeout = timeout
+
+
+    def __getattr__(self, name):
+        return getattr(self._session, name)
+
+
+    def qualify(self, query):
+        return _TABLE_NAME.sub\
+            (lambda m: '%s %s.%s' % (m.group(1), self._keyspace,
+                                     m.group(2)),
+             query)
+
+
+    def _args(self, query, kwargs):
+        if isinstance(query, str):
+            query = self.qualify(query)
+        if self._timeout is not None:
+            kwargs.setdefault('timeout', self._timeout)
+        return query, kwargs
+
+
+    def prepare(self, query):
+        return self._session.prepare(self.qualify(query))
+
+
+    def execute(self, query, parameters = None, **kwargs):
+        query, kwargs = self._args(query, kwargs)
+        return self._session.execute(query, parameters, **kwargs)
+
+
+    def execute_async(self, query, parameters = None, **kwargs):
+        query, kwargs = self._args(query, kwargs)
+        return self._session.execute_async(query, parameters, **kwargs)
+
+
+def shutdown():
+    """Shutdown all shared sessions and clusters
+
+    """
+    with _REGISTRY_LOCK:
+        for _, session in _SESSIONS.values():
+            session.shutdown()
+        for cluster in _CLUSTERS.values():
+            cluster.shutdown()
+        _SESSIONS.clear()
+        _CLUSTERS.clear()
 
 
 class Cassandra_Base:
@@ -8,9 +193,13 @@ class Cassandra_Base:
     def __init__(self, cluster_ips, keyspace,
                  replication = 'SimpleStrategy',
                  replication_args = {'replication_factor': 1},
+                 read_only = False,
                  **kwargs):
         """Init keyspace
 
+        Instances share clusters and sessions (see get_cluster and
+        get_session), statements name tables with their keyspace.
+
         :keyspace: name of the keyspace
 
         :cluster_ips: cluster ips
@@ -18,21 +207,31 @@ class Cassandra_Base:
         :replication, replication_args: replication strategy and its
         arguments
 
-        :kwargs: arguments passed to Cluster
+        :read_only: if True, attach to an existing schema without
+        running any DDL. Missing keyspace or tables raise
+        RuntimeError. Otherwise missing parts of the schema are
+        created (see ensure_schema).
+
+        :kwargs: arguments passed to get_cluster
         """
         self._keyspace = keyspace
         self._keyspace_replication = replication
         self._keyspace_replication_args = replication_args
         self._cluster_ips = cluster_ips
+        self._read_only = read_only
 
         self._queries = {}
         self._queries.update(self._add_queries())
 
-        self._cluster = Cluster\
-            (contact_points=self._cluster_ips,
-             load_balancing_policy=DCAwareRoundRobinPolicy(local_dc='datacenter1'),
-             **kwargs)
-        self.init_keyspace()
+        self._cluster = get_cluster(self._cluster_ips, **kwargs)
+        if read_only:
+            # metadata is available after connecting
+            get_session(self._cluster)
+            if self._keyspace not in self._cluster.metadata.keyspaces:
+                raise RuntimeError("keyspace %s does not exist" \
+                                   % self._keyspace)
+        else:
+            self.init_keyspace()
 
 
     def _add_queries(self):
@@ -52,13 +251,88 @@ class Cassandra_Base:
         return res
 
 
+    def _create_tables_queries(self):
+        return {}
+
+
+    def _tables(self):
+        keyspace = self._cluster.metadata.keyspaces.get(self._keyspace)
+        if keyspace is None:
+            return {}
+
+        return keyspace.tables
+
+
+    def _attach(self, timeout):
+        """Connect to the keyspace and create or check its schema
+
+        :timeout: timeout of requests of this instance
+
+        """
+        self._session = Keyspace_Session(get_session(self._cluster),
+                                         self._keyspace, timeout)
+        if self._read_only:
+            self._check_schema()
+        else:
+            self.ensure_schema()
+        self._queries.update(self._create_tables_queries())
+
+
+    def _check_schema(self):
+        tables = self._tables()
+        missing = [_table_name(x) for x in \
+                   self._create_tables_queries().values() \
+                   if _table_name(x) not in tables]
+        if missing:
+            raise RuntimeError("missing tables in %s: %s" \
+                               % (self._keyspace, ', '.join(missing)))
+
+
+    def _prepare(self, query):
+        """Prepare a statement in the background
+
+        :return: a future, resolved by _add_prepared
+        """
+        return _PREPARE_POOL.submit(self._session.prepare, query)
+
+
+    def _add_prepared(self, *queries):
+        """Add queries, waiting for statements from _prepare
+
+        :queries: dictionaries of queries
+
+        """
+        for x in queries:
+            self._queries.update\
+                ({k: v.result() if isinstance(v, Future) else v \
+                  for k, v in x.items()})
+
+
+    def ensure_schema(self):
+        """Create the keyspace and tables if they do not exist
+
+        Existing ones are looked up in the cached cluster metadata,
+        so that no DDL is sent for them.
+
+        """
+        self.init_keyspace()
+
+        tables = self._tables()
+        for query in self._create_tables_queries().values():
+            if _table_name(query) not in tables:
+                self._session.execute(query)
+
+
     def init_keyspace(self):
-        session = self._cluster.connect()
+        session = get_session(self._cluster)
+        if self._keyspace in self._cluster.metadata.keyspaces:
+            return
+
         session.execute\
             (self._queries['init_keyspace'])
 
 
     def drop_keyspace(self):
-        session = self._cluster.connect()
+        session = get_session(self._cluster)
         session.execute\
             (self._queries['drop_keyspace'])
@@ -0,0 +1,90 @@
+import os
+
+from cassandra_io import base
+
+from cassandra_io.files import \
+    Cassandra_Files
+from cassandra_io.spatial_index import \
+    Cassandra_Spatial_Index
+
+
+# tests run on a live cluster with CASSANDRA_IO_TEST_BACKEND=cassandra
+BACKEND = os.environ.get('CASSANDRA_IO_TEST_BACKEND', 'sqlite')
+
+
+def test_get_cluster():
+    try:
+        x = base.get_cluster(['127.0.0.2', '127.0.0.1'])
+        assert x is base.get_cluster(['127.0.0.1', '127.0.0.2'])
+        assert x is not base.get_cluster(['127.0.0.1'])
+        assert x is not base.get_cluster(['127.0.0.1', '127.0.0.2'],
+                                         connections_per_host = 4,
+                                         max_requests_per_connection = 64)
+    finally:
+        base.shutdown()
+    assert x is not base.get_cluster(['127.0.0.1', '127.0.0.2'])
+    base.shutdown()
+
+
+def test_shared_session(ips = ['172.17.0.2'], backend = BACKEND):
+    try:
+        cfs = Cassandra_Files(keyspace_suffix = '_test_shared',
+                              cluster_ips = ips, backend = backend)
+        cfs2 = Cassandra_Files(keyspace_suffix = '_test_shared',
+                               cluster_ips = ips, backend = backend)
+        csi = Cassandra_Spatial_Index(keyspace = 'test_shared',
+                                      cluster_ips = ips, backend = backend)
+        csi2 = Cassandra_Spatial_Index(keyspace = 'test_shared',
+                                       cluster_ips = ips, backend = backend,
+                                       timeout = 5)
+
+        assert cfs._cluster is cfs2._cluster
+        assert cfs._cluster is csi._cluster
+
+        # one session, and so one connection pool, for all keyspaces
+        # and timeouts
+        session = base.get_session(cfs._cluster)
+        for x in (cfs, cfs2, csi, csi2):
+            assert x._session._session is session
+        assert 5 == csi2._session._timeout
+        assert 'SELECT hash FROM %s.hash2 WHERE hash=?' % csi._keyspace \
+            == csi._session.qualify('SELECT hash FROM hash2 WHERE hash=?')
+
+        # dropping a keyspace keeps the session open
+        cfs.drop_keyspace()
+        assert not session.is_shutdown
+        cfs = Cassandra_Files(keyspace_suffix = '_test_shared',
+                              cluster_ips = ips, backend = backend)
+        assert cfs._session._session is session
+        assert 0 == csi2.intersect([(0,0),(0,1),(1,1),(1,0)]).size()
+    finally:
+        try:
+            cfs.drop_keyspace()
+        except:
+            pass
+        try:
+            csi.drop_keyspace()
+        except:
+            pass
+
+
+def test_read_only(ips = ['172.17.0.2'], backend = BACKEND):
+    try:
+        try:
+            Cassandra_Files(keyspace_suffix = '_test_read_only',
+                            cluster_ips = ips, backend = backend, read_only = True)
+            assert False
+        except RuntimeError:
+            pass
+
+        cfs = Cassandra_Files(keyspace_suffix = '_test_read_only',
+                              cluster_ips = ips, backend = backend)
+        cfs.ensure_schema()
+        x = Cassandra_Files(keyspace_suffix = '_test_read_only',
+                            cluster_ips = ips, backend = backend, read_only = True)
+        assert 'dummy' not in x
+    finally:
+        try:
+            cfs.drop_keyspace()
+        except:
+            pass
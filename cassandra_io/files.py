@@ -1,11 +1,34 @@
+import os
+import math
 import logging
 import time
+import hashlib
+import functools
+import itertools
+import collections
 
+from cassandra_io import metrics
 from cassandra_io.base import Cassandra_Base
 
 from cassandra_io.utils import \
     read_by_chunks, write_by_chunks, \
-    write_bytesio_by_chunk, hash_any
+    write_bytesio_by_chunk, hash_any, file_hash, remove_file
+
+
+def _chunk_written(size):
+    metrics.inc('files_chunks_written')
+    metrics.inc('files_bytes_written', size)
+
+
+def _unchanged(stored, local, compare):
+    # (size, mtime, hash) of a stored and a local file
+    if stored is None or local is None:
+        return False
+
+    if 'hash' == compare:
+        return stored[2] == local[2]
+
+    return stored[:2] == local[:2]
 
 
 class Cassandra_Files(Cassandra_Base):
@@ -23,7 +46,11 @@ class Cassandra_Files(Cassandra_Base):
     Use 'download' to download file to a local file, and
     'download_bytesio' to download file to a memory bytes stream.
 
-    Dangling chunks can be removed with 'cleanup' method.
+    Use 'sync_dir' and 'sync_down' to mirror a local directory tree.
+
+    Dangling chunks can be removed with 'cleanup' method. Files
+    uploaded with a TTL expire in compaction instead, including their
+    superseded versions.
 
     Note that 'delete' and 'cleanup' will not remove actual physical
     space on cassandra.
@@ -34,13 +61,22 @@ class Cassandra_Files(Cassandra_Base):
     def __init__(self, keyspace_suffix='',
                  chunk_size = 1048576,
                  timeout = 120,
+                 ttl = None,
                  **kwargs):
         """
         :keyspace_suffix: suffix of the keyspace
 
         :chunk_size: size of chunks to write for files
 
-        :timeout: cluster session default_timeout
+        :timeout: timeout of requests in seconds
+
+        :ttl: default time to live of uploaded files in seconds, None
+        keeps files until they are deleted. Every version expires
+        with its own TTL, so that superseded versions need no
+        'cleanup'. If set, the chunk tables are created with
+        TimeWindowCompactionStrategy, so that expired chunks are
+        dropped as whole sstables. The compaction of existing tables
+        is not changed.
 
         :kwargs: arguments passed to Cassandra_Base
 
@@ -48,18 +84,27 @@ class Cassandra_Files(Cassandra_Base):
         if 'keyspace' not in kwargs:
             kwargs['keyspace'] = 'cassandra_files'
         kwargs['keyspace'] += '_' + keyspace_suffix
+        self._ttl = ttl
         super().__init__(**kwargs)
         self._chunk_size = chunk_size
 
-        self._session = self._cluster.connect(self._keyspace)
-        self._session.default_timeout = timeout
-        queries = self._create_tables_queries()
-        for _, query in queries.items():
-            self._session.execute(query)
-        self._queries.update(queries)
-        self._queries.update(self._insert_queries())
-        self._queries.update(self._select_queries())
-        self._queries.update(self._delete_queries())
+        self._attach(timeout)
+        self._add_prepared(self._insert_queries(),
+                           self._select_queries(),
+                           self._delete_queries())
+
+
+    def _table_options(self):
+        if self._ttl is None:
+            return ''
+
+        # about 20 time windows per TTL
+        window = max(1, math.ceil(self._ttl / 3600 / 20))
+        return """
+            WITH compaction = {
+            'class': 'TimeWindowCompactionStrategy',
+            'compaction_window_unit': 'HOURS',
+            'compaction_window_size': %d}""" % window
 
 
     def _create_tables_queries(self):
@@ -72,14 +117,16 @@ class Cassandra_Files(Cassandra_Base):
             timestamp text,
             chunk_order int,
             chunk_id text,
-            PRIMARY KEY (filename, timestamp, chunk_order))"""
+            PRIMARY KEY (filename, timestamp, chunk_order))""" \
+            + self._table_options()
         res['create_files_inode'] = """
             CREATE TABLE IF NOT EXISTS
             files_inode
             (
             chunk_id text,
             chunk blob,
-            PRIMARY KEY(chunk_id))"""
+            PRIMARY KEY(chunk_id))""" \
+            + self._table_options()
         res['create_files_timestamp'] = """
             CREATE TABLE IF NOT EXISTS
             files_timestamp
@@ -87,6 +134,16 @@ class Cassandra_Files(Cassandra_Base):
             filename text,
             timestamp text,
             PRIMARY KEY(filename))"""
+        res['create_files_meta'] = """
+            CREATE TABLE IF NOT EXISTS
+            files_meta
+            (
+            prefix text,
+            path text,
+            size bigint,
+            mtime double,
+            hash text,
+            PRIMARY KEY(prefix, path))"""
 
         return res
 
@@ -97,16 +154,24 @@ class Cassandra_Files(Cassandra_Base):
             INSERT INTO files
             (filename, timestamp, chunk_order, chunk_id)
             VALUES (%s, %s, %s, %s)
-            IF NOT EXISTS"""
+            IF NOT EXISTS
+            USING TTL %s"""
         res['insert_files_inode'] = """
             INSERT INTO files_inode
             (chunk_id, chunk)
             VALUES (%s, %s)
-            IF NOT EXISTS"""
+            IF NOT EXISTS
+            USING TTL %s"""
         res['insert_files_timestamp'] = """
             INSERT INTO files_timestamp
             (filename, timestamp)
-            VALUES (%s, %s)"""
+            VALUES (%s, %s)
+            USING TTL %s"""
+        res['insert_files_meta'] = """
+            INSERT INTO files_meta
+            (prefix, path, size, mtime, hash)
+            VALUES (%s, %s, %s, %s, %s)
+            USING TTL %s"""
 
         return res
 
@@ -114,13 +179,13 @@ class Cassandra_Files(Cassandra_Base):
     def _delete_queries(self):
         res = {}
         res['delete_from_files_inode'] = \
-            self._session.prepare\
+            self._prepare\
             ("""
             DELETE FROM files_inode
             WHERE chunk_id=?
             IF EXISTS""")
         res['delete_from_files'] = \
-            self._session.prepare\
+            self._prepare\
             ("""
             DELETE FROM files
             WHERE timestamp=?
@@ -128,11 +193,16 @@ class Cassandra_Files(Cassandra_Base):
             and chunk_order=?
             IF EXISTS""")
         res['delete_from_files_timestamp'] = \
-            self._session.prepare\
+            self._prepare\
             ("""
             DELETE FROM files_timestamp
             WHERE filename=?
             IF EXISTS""")
+        res['delete_from_files_meta'] = \
+            self._prepare\
+            ("""
+            DELETE FROM files_meta
+            WHERE prefix=? and path=?""")
 
         return res
 
@@ -140,57 +210,64 @@ class Cassandra_Files(Cassandra_Base):
     def _select_queries(self):
         res = {}
         res['select_current_timestamp'] = \
-            self._session.prepare\
+            self._prepare\
             ("""
             SELECT timestamp
             FROM files_timestamp
             WHERE filename=?""")
         res['select_chunk_id'] = \
-            self._session.prepare\
+            self._prepare\
             ("""
             SELECT chunk_id
             FROM files
             WHERE filename=? and timestamp=?""")
         res['select_chunk'] = \
-            self._session.prepare\
+            self._prepare\
             ("""
             SELECT chunk
             FROM files_inode
             WHERE chunk_id=?""")
         res['select_current_filenames'] = \
-            self._session.prepare\
+            self._prepare\
             ("""
             SELECT filename, timestamp
             FROM files_timestamp
             """)
         res['select_all_chunks'] = \
-            self._session.prepare\
+            self._prepare\
             ("""
             SELECT filename, timestamp, chunk_order, chunk_id
             FROM files
             WHERE
             filename=?""")
         res['select_older_chunks'] = \
-            self._session.prepare\
+            self._prepare\
             ("""
             SELECT filename, timestamp, chunk_order, chunk_id
             FROM files
             WHERE
             filename=? and timestamp<?""")
         res['select_contains'] = \
-            self._session.prepare\
+            self._prepare\
             ("""
             SELECT count(*)
             FROM files_timestamp
             WHERE
             filename=?""")
         res['select_timestamp'] = \
-            self._session.prepare\
+            self._prepare\
             ("""
             SELECT timestamp
             FROM files_timestamp
             WHERE
             filename=?""")
+        res['select_files_meta'] = \
+            self._prepare\
+            ("""
+            SELECT path, size, mtime, hash
+            FROM files_meta
+            WHERE
+            prefix=?""")
 
         return res
 
@@ -215,10 +292,13 @@ class Cassandra_Files(Cassandra_Base):
 
         for chunk_id in chunk_order:
             try:
-                yield self._session.execute\
+                chunk = self._session.execute\
                     (self._queries['select_chunk'],
                      [chunk_id[0]])\
                      .one()[0]
+                metrics.inc('files_chunks_read')
+                metrics.inc('files_bytes_read', len(chunk))
+                yield chunk
             except Exception as e:
                 logging.error("""
                 _get_file_chunks
@@ -272,9 +352,10 @@ class Cassandra_Files(Cassandra_Base):
         cassandra_io:files.py:download
         cassandra_fn: %s
         ofn: %s
-        """ % (cassandra_fn, ofn))
-        write_by_chunks(self._get_file_chunks(cassandra_fn),
-                        ofn = ofn)
+        """, cassandra_fn, ofn)
+        with metrics.timer('files_download_seconds'):
+            write_by_chunks(self._get_file_chunks(cassandra_fn),
+                            ofn = ofn)
 
 
     def download_bytesio(self, cassandra_fn):
@@ -318,18 +399,99 @@ class Cassandra_Files(Cassandra_Base):
         self._delete(chunks)
 
 
-    def upload(self, ifn, cassandra_fn):
+    def upload(self, ifn, cassandra_fn, ttl = None):
         """Upload file to the cassandra storage
 
         :ifn: path to the local filename
 
         :cassandra_fn: filename in the cassandra storage
 
+        :ttl: time to live of this version in seconds, None for the
+        default of the instance, 0 for no expiry
+
         """
         timestamp = str(time.time())
+        if ttl is None:
+            ttl = self._ttl or 0
+
+        with metrics.timer('files_upload_seconds'):
+            self._pipeline(self._upload_requests\
+                           (ifn, cassandra_fn, timestamp, int(ttl)),
+                           concurrency = 1)
+
+
+    def _pipeline(self, requests, concurrency):
+        """Execute requests with a bounded number in flight
 
+        :requests: iterable of (query name, parameters), optionally
+        followed by a function called once the request completed, or
+        functions called once all earlier requests completed, which
+        return further requests
+
+        :concurrency: number of requests in flight
+
+        """
+        pending = collections.deque()
+
+        def submit(request):
+            name, params = request[:2]
+            pending.append((self._session.execute_async\
+                            (self._queries[name], params),
+                            request[2:]))
+
+        def wait(size):
+            while len(pending) > size:
+                x = pending.popleft()
+                if callable(x):
+                    for request in x():
+                        submit(request)
+                    continue
+
+                future, done = x
+                future.result()
+                for fun in done:
+                    fun()
+
+        for x in requests:
+            if callable(x):
+                pending.append(x)
+                continue
+
+            wait(concurrency - 1)
+            submit(x)
+        wait(0)
+
+
+    def _upload_requests(self, ifn, cassandra_fn, timestamp, ttl,
+                         after = None):
+        """Requests writing a file, see _pipeline
+
+        Rows expire ttl seconds after the start of the upload, not
+        after they are written. As TTLs are whole seconds, chunks are
+        kept a second longer, so that the current version expires
+        before its chunks. A version that expires during the upload
+        is not made current.
+
+        :ttl: time to live in seconds, 0 for no expiry
+
+        :after: function of the sha512 hex digest of the file
+        content and the TTL of the current version, returns requests
+        run with its update
+
+        """
+        expiry = time.time() + ttl
+
+        def left():
+            if not ttl:
+                return 0
+            return int(math.ceil(expiry - time.time()))
+
+        # the hash is computed from the uploaded chunks, the file is
+        # read once
+        h = hashlib.sha512()
         for chunk_order, data in enumerate\
             (read_by_chunks(ifn, self._chunk_size)):
+            h.update(data)
             # hashing timestamp and filename prevents problems with
             # files deleting. however, this does not allow
             # deduplication, e.g. two identical files will occupy
@@ -338,14 +500,150 @@ class Cassandra_Files(Cassandra_Base):
             # involves counters, and they can be buggy in cassandra.
             chunk_id = hash_any((cassandra_fn,
                                  timestamp, data))
-            self._session.execute\
-                (self._queries['insert_files'],
-                 (cassandra_fn, timestamp,
-                  chunk_order, chunk_id))
-            self._session.execute\
-                (self._queries['insert_files_inode'],
-                 (chunk_id, data))
+            chunk_ttl = max(1, left() + 1) if ttl else 0
+            yield 'insert_files', (cassandra_fn, timestamp,
+                                   chunk_order, chunk_id, chunk_ttl)
+            yield 'insert_files_inode', (chunk_id, data, chunk_ttl), \
+                functools.partial(_chunk_written, len(data))
 
-        self._session.execute\
-            (self._queries['insert_files_timestamp'],
-             (cassandra_fn, timestamp))
+        def current():
+            version_ttl = left()
+            if ttl and version_ttl < 1:
+                return []
+            return [('insert_files_timestamp',
+                     (cassandra_fn, timestamp, version_ttl))] \
+                     + (list(after(h.hexdigest(), version_ttl)) \
+                        if after else [])
+
+        # the version becomes current once all chunks are written
+        yield current
+
+
+    def _sync_name(self, prefix, path):
+        if not prefix:
+            return path
+
+        return prefix.rstrip('/') + '/' + path
+
+
+    def _stored_meta(self, prefix):
+        return {x[0]: tuple(x[1:]) for x in self._session.execute\
+                (self._queries['select_files_meta'],
+                 [prefix])}
+
+
+    def _local_meta(self, local_dir, compare):
+        if compare not in ('mtime', 'hash'):
+            raise RuntimeError("unknown compare: %s" % compare)
+
+        res = {}
+        for root, _, files in os.walk(local_dir):
+            for fn in files:
+                fn = os.path.join(root, fn)
+                path = os.path.relpath(fn, local_dir)\
+                             .replace(os.sep, '/')
+                st = os.stat(fn)
+                res[path] = (st.st_size, st.st_mtime,
+                             file_hash(fn) if 'hash' == compare else None)
+
+        return res
+
+
+    def sync_dir(self, local_dir, prefix, compare = 'mtime',
+                 delete = False, concurrency = 32, ttl = None):
+        """Upload new and changed files of a local directory tree
+
+        Files are stored as prefix/relative_path. Their size,
+        modification time and content hash are kept in the
+        files_meta table and compared with local files. Chunks of all
+        changed files are written concurrently. Files uploaded
+        otherwise are not tracked.
+
+        :local_dir: local directory
+
+        :prefix: prefix of stored filenames
+
+        :compare: 'mtime' compares sizes and modification times,
+        'hash' compares content hashes, which reads all local files
+
+        :delete: if True, stored files of the prefix that do not
+        exist locally are deleted
+
+        :concurrency: number of write requests in flight
+
+        :ttl: see upload
+
+        :return: list of relative paths of uploaded files
+        """
+        local = self._local_meta(local_dir, compare)
+        stored = self._stored_meta(prefix)
+        if ttl is None:
+            ttl = self._ttl or 0
+
+        changed = [x for x in sorted(local) \
+                   if not _unchanged(stored.get(x), local[x], compare)]
+
+        def after(path):
+            # hashes of uploaded content are stored for later
+            # comparisons by content
+            return lambda digest, version_ttl: \
+                [('insert_files_meta',
+                  (prefix, path) + local[path][:2] \
+                  + (digest, version_ttl))]
+
+        requests = itertools.chain.from_iterable\
+            (self._upload_requests\
+             (os.path.join(local_dir, x), self._sync_name(prefix, x),
+              str(time.time()), int(ttl), after = after(x)) \
+             for x in changed)
+
+        with metrics.timer('files_sync_seconds'):
+            self._pipeline(requests, concurrency)
+        metrics.inc('files_synced', len(changed))
+
+        if delete:
+            for x in set(stored) - set(local):
+                self.delete(self._sync_name(prefix, x))
+                self._session.execute\
+                    (self._queries['delete_from_files_meta'],
+                     [prefix, x])
+
+        return changed
+
+
+    def sync_down(self, prefix, local_dir, compare = 'mtime',
+                  delete = False):
+        """Download files of a prefix missing or stale locally
+
+        Files are compared with the metadata stored by sync_dir,
+        downloaded files get the stored modification time.
+
+        :prefix: prefix of stored filenames, see sync_dir
+
+        :local_dir: local directory
+
+        :compare: see sync_dir
+
+        :delete: if True, local files that are not stored are
+        deleted
+
+        :return: list of relative paths of downloaded files
+        """
+        local = self._local_meta(local_dir, compare)
+        stored = self._stored_meta(prefix)
+
+        res = []
+        for x in sorted(stored):
+            if _unchanged(stored[x], local.get(x), compare):
+                continue
+
+            ofn = os.path.join(local_dir, *x.split('/'))
+            self.download(self._sync_name(prefix, x), ofn)
+            os.utime(ofn, (stored[x][1], stored[x][1]))
+            res += [x]
+
+        if delete:
+            for x in set(local) - set(stored):
+                remove_file(os.path.join(local_dir, *x.split('/')))
+
+        return res
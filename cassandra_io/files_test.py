@@ -1,3 +1,9 @@
+import os
+import time
+import shutil
+import tempfile
+
+from cassandra_io import metrics
 from cassandra_io.files import \
     Cassandra_Files
 
@@ -6,11 +12,15 @@ from cassandra_io.utils import \
     remove_file
 
 
-def test_files(ips = ['172.17.0.2']):
+# tests run on a live cluster with CASSANDRA_IO_TEST_BACKEND=cassandra
+BACKEND = os.environ.get('CASSANDRA_IO_TEST_BACKEND', 'sqlite')
+
+
+def test_files(ips = ['172.17.0.2'], backend = BACKEND):
     try:
         touch_random('dummy', 5242880)
         cfs = Cassandra_Files(keyspace_suffix = '_test_files',
-                              cluster_ips = ips)
+                              cluster_ips = ips, backend = backend)
 
         cfs.upload('dummy','dummy')
         cfs.upload('dummy','dummy')
@@ -39,3 +49,100 @@ def test_files(ips = ['172.17.0.2']):
             pass
         remove_file('dummy')
         remove_file('dummy_test')
+
+
+def test_files_ttl(ips = ['172.17.0.2'], backend = BACKEND):
+    try:
+        touch_random('dummy', 1024)
+        cfs = Cassandra_Files(keyspace_suffix = '_test_files_ttl',
+                              cluster_ips = ips, backend = backend,
+                              ttl = 3600, chunk_size = 256)
+        assert 'TimeWindowCompactionStrategy' \
+            in cfs._queries['create_files_inode']
+
+        cfs.upload('dummy', 'transient')
+        cfs.upload('dummy', 'kept', ttl = 0)
+        cfs.upload('dummy', 'expired', ttl = 1)
+        assert 'transient' in cfs
+        assert 'expired' in cfs
+        assert file_hash('dummy') == get_hash\
+            (cfs.download_bytesio('transient').read())
+        assert file_hash('dummy') == get_hash\
+            (cfs.download_bytesio('kept').read())
+
+        time.sleep(1.5)
+        assert 'expired' not in cfs
+        assert 'transient' in cfs
+        assert 'kept' in cfs
+
+        class Slow:
+            # chunks are written slowly, the upload takes about 1.2s
+            def __init__(self, session):
+                self._session = session
+
+            def __getattr__(self, name):
+                return getattr(self._session, name)
+
+            def execute_async(self, q, *args, **kwargs):
+                if q is cfs._queries['insert_files_inode']:
+                    time.sleep(0.3)
+                return self._session.execute_async(q, *args, **kwargs)
+
+        # the version expires with its first chunk, not a TTL later
+        session, cfs._session = cfs._session, Slow(cfs._session)
+        start = time.time()
+        cfs.upload('dummy', 'slow', ttl = 2)
+        cfs._session = session
+        assert 1 < time.time() - start < 2
+        assert file_hash('dummy') == get_hash\
+            (cfs.download_bytesio('slow').read())
+        time.sleep(start + 2.6 - time.time())
+        assert 'slow' not in cfs
+    finally:
+        try:
+            cfs.drop_keyspace()
+        except:
+            pass
+        remove_file('dummy')
+
+
+def test_files_sync(ips = ['172.17.0.2'], backend = BACKEND):
+    src, dst = tempfile.mkdtemp(), tempfile.mkdtemp()
+    try:
+        cfs = Cassandra_Files(keyspace_suffix = '_test_files_sync',
+                              cluster_ips = ips, backend = backend,
+                              chunk_size = 256)
+        os.makedirs(os.path.join(src, 'sub'))
+        for x in ['a', 'b', os.path.join('sub', 'c')]:
+            touch_random(os.path.join(src, x), 1000)
+
+        assert ['a', 'b', 'sub/c'] == cfs.sync_dir(src, 'run')
+        assert 'run/sub/c' in cfs
+        assert [] == cfs.sync_dir(src, 'run')
+        assert [] == cfs.sync_dir(src, 'run', compare = 'hash')
+
+        touch_random(os.path.join(src, 'b'), 2000)
+        remove_file(os.path.join(src, 'a'))
+        try:
+            m = metrics.enable()
+            assert ['b'] == cfs.sync_dir(src, 'run', delete = True)
+            assert 8 == m.counter('files_chunks_written')
+            assert 2000 == m.counter('files_bytes_written')
+        finally:
+            metrics.disable()
+        assert 'run/a' not in cfs
+        # hashes stored with mtime comparisons are of the content
+        assert [] == cfs.sync_dir(src, 'run', compare = 'hash')
+
+        assert ['b', 'sub/c'] == cfs.sync_down('run', dst)
+        assert [] == cfs.sync_down('run', dst)
+        for x in ['b', os.path.join('sub', 'c')]:
+            assert file_hash(os.path.join(src, x)) \
+                == file_hash(os.path.join(dst, x))
+    finally:
+        try:
+            cfs.drop_keyspace()
+        except:
+            pass
+        shutil.rmtree(src, ignore_errors = True)
+        shutil.rmtree(dst, ignore_errors = True)
@@ -0,0 +1,220 @@
+import time
+import bisect
+import threading
+import contextlib
+
+
+# half decades from 10us to 1e6, suitable for seconds and counts
+BUCKETS = tuple(10**(k/2) for k in range(-10, 13))
+
+
+class Histogram:
+
+    def __init__(self, buckets = BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0
+
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+
+    def quantile(self, q):
+        """Upper bound of the bucket containing a quantile
+
+        """
+        if not self.count:
+            return None
+
+        rank, total = q * self.count, 0
+        for bound, n in zip(self.buckets + (float('inf'),),
+                            self.counts):
+            total += n
+            if total >= rank:
+                return bound
+
+
+class Metrics:
+    """Counters and histograms of named events
+
+    Exporters are functions called as fun(kind, name, value) for
+    every event, kind is 'counter' or 'histogram'.
+
+    """
+
+    def __init__(self, buckets = BUCKETS):
+        self._buckets = buckets
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._exporters = []
+
+
+    def add_exporter(self, fun):
+        self._exporters += [fun]
+
+
+    def inc(self, name, value = 1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+        for fun in self._exporters:
+            fun('counter', name, value)
+
+
+    def observe(self, name, value):
+        with self._lock:
+            if name not in self._histograms:
+                self._histograms[name] = Histogram(self._buckets)
+            self._histograms[name].observe(value)
+        for fun in self._exporters:
+            fun('histogram', name, value)
+
+
+    def counter(self, name):
+        return self._counters.get(name, 0)
+
+
+    def histogram(self, name):
+        return self._histograms.get(name)
+
+
+    def snapshot(self):
+        """Current values
+
+        :return: dictionary with counters and count, sum and
+        p50/p95/p99 bucket bounds of histograms
+        """
+        with self._lock:
+            return {'counters': dict(self._counters),
+                    'histograms': \
+                    {k: {'count': v.count, 'sum': v.sum,
+                         'p50': v.quantile(0.5),
+                         'p95': v.quantile(0.95),
+                         'p99': v.quantile(0.99)} \
+                     for k, v in self._histograms.items()}}
+
+
+    def prometheus(self, prefix = 'cassandra_io_'):
+        """Values in the Prometheus text format
+
+        """
+        res = []
+        with self._lock:
+            for name, value in sorted(self._counters.items()):
+                res += ['# TYPE %s%s counter' % (prefix, name),
+                        '%s%s %s' % (prefix, name, value)]
+            for name, x in sorted(self._histograms.items()):
+                res += ['# TYPE %s%s histogram' % (prefix, name)]
+                total = 0
+                for bound, n in zip(x.buckets + (float('inf'),),
+                                    x.counts):
+                    total += n
+                    res += ['%s%s_bucket{le="%s"} %d' \
+                            % (prefix, name,
+                               '+Inf' if bound == float('inf') \
+                               else '%g' % bound, total)]
+                res += ['%s%s_sum %s' % (prefix, name, x.sum),
+                        '%s%s_count %d' % (prefix, name, x.count)]
+
+        return '\n'.join(res) + '\n'
+
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+
+# metrics are collected only if enabled
+_METRICS = None
+
+
+def enable(metrics = None):
+    """Start collecting metrics
+
+    :metrics: a Metrics, None creates a new one
+
+    :return: the Metrics collecting events
+    """
+    global _METRICS
+    _METRICS = Metrics() if metrics is None else metrics
+    return _METRICS
+
+
+def disable():
+    global _METRICS
+    _METRICS = None
+
+
+def get():
+    """Metrics collecting events, None if disabled
+
+    """
+    return _METRICS
+
+
+def inc(name, value = 1):
+    if _METRICS is not None:
+        _METRICS.inc(name, value)
+
+
+def observe(name, value):
+    if _METRICS is not None:
+        _METRICS.observe(name, value)
+
+
+class _Timer:
+
+    def __init__(self, metrics, name):
+        self._metrics = metrics
+        self._name = name
+
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+
+    def __exit__(self, *args):
+        self._metrics.observe(self._name,
+                              time.perf_counter() - self._start)
+
+
+_NO_TIMER = contextlib.nullcontext()
+
+
+def timer(name):
+    """Context manager observing its duration in seconds
+
+    """
+    if _METRICS is None:
+        return _NO_TIMER
+
+    return _Timer(_METRICS, name)
+
+
+def request_listener(future):
+    """Count requests and their latency
+
+    Registered with Session.add_request_init_listener for shared
+    sessions (see base.get_session).
+
+    """
+    metrics = _METRICS
+    if metrics is None:
+        return
+
+    metrics.inc('requests')
+    start = time.perf_counter()
+
+    def callback(*args):
+        metrics.observe('request_seconds', time.perf_counter() - start)
+
+    def errback(*args):
+        metrics.inc('request_errors')
+
+    future.add_callbacks(callback, errback)
@@ -0,0 +1,32 @@
+from cassandra_io import metrics
+from cassandra_io.polygon_index import \
+    Polygon_File_Index
+
+
+def test_metrics():
+    data = [{'file': str(i),
+             'polygon': [(i,0),(i,1),(i+1,1),(i+1,0)]} \
+            for i in range(100)]
+    x = Polygon_File_Index(data)
+
+    events = []
+    try:
+        m = metrics.enable()
+        m.add_exporter(lambda *args: events.append(args))
+
+        x.intersect([(10,0),(10,1),(12,1),(12,0)])
+        with metrics.timer('test_seconds'):
+            pass
+
+        assert 4 == m.counter('polygon_index_candidates')
+        assert 2 == m.counter('polygon_index_results')
+        assert 1 == m.histogram('test_seconds').count
+        assert ('counter', 'polygon_index_results', 2) in events
+        assert 'cassandra_io_test_seconds_count 1' in m.prometheus()
+        assert 1 == m.snapshot()['histograms']['test_seconds']['count']
+    finally:
+        metrics.disable()
+
+    x.intersect([(10,0),(10,1),(12,1),(12,0)])
+    assert 2 == m.counter('polygon_index_results')
+    assert metrics.get() is None
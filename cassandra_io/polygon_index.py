@@ -1,28 +1,230 @@
+import os
 import re
 import json
+import itertools
+
+import shapely
+import numpy as np
 
 from rtree import index
 from shapely import geometry
 
-import hashlib
+from cassandra_io import metrics
+from cassandra_io.utils import json_default, remove_file, LRU_Cache
+from cassandra_io.polygon_records import \
+    Data_Records, Packed_Records, Record_Columns, \
+    pack_records, load_records
+
 
+def _bounds(coords):
+    if isinstance(coords, np.ndarray):
+        return tuple(coords.min(axis = 0)) + tuple(coords.max(axis = 0))
 
-def hash_string(string):
-    h = hashlib.md5()
-    h.update(string.encode('utf-8'))
-    return int(h.hexdigest(), 16)
+    # faster than numpy for short lists
+    xs, ys = zip(*coords)
+    return (min(xs), min(ys), max(xs), max(ys))
 
 
 class Polygon_File_Index:
 
-    def __init__(self):
+    def __init__(self, records = None, compact = False,
+                 geometry_cache = None):
         """A spatial file index for polygon areas boosted by an R-Tree
 
         The index contains unique 'file' fields.
 
+        :records: an optional iterable of data (see insert). The
+        R-tree is bulk loaded, which is faster than inserting data
+        one by one and results in a better tree.
+
+        :compact: if True, data is packed into shared arrays (see
+        polygon_records.py) and decoded on access, instead of being
+        kept as dictionaries. Indices produced by intersect and
+        filter inherit this option.
+
+        :geometry_cache: number of shapely polygons kept after
+        construction. None keeps all of them
+
         """
-        self._polygons = dict()
+        self._compact = compact
+        self._geometry_cache = geometry_cache
+
+        # records are kept in insertion order, R-tree ids are their
+        # positions. The R-tree is only used for spatial queries
+        self._records = Packed_Records() if compact else Data_Records()
+        self._columns = Record_Columns(self._records)
+        self._positions = dict()
+        self._geometries = LRU_Cache(maxsize = geometry_cache)
         self._rtree = index.Index()
+        # directory of the R-tree files, if opened with load_binary
+        self._path = None
+        # (STRtree, positions, files) used by locate_many, built on
+        # demand
+        self._strtree = None
+        # bool array of positions and its size for views made by
+        # filter
+        self._mask = None
+        self._mask_size = 0
+        # number of changes, shared with views. A view records it
+        # when made and refuses to work after a change of the index
+        self._version = [0]
+        self._view_version = 0
+        # R-tree is rebuilt after as many updates as records
+        self._updates = 0
+
+        if records is not None:
+            self._bulk_load(records)
+
+
+    def _append(self, data):
+        pos = len(self._records)
+        self._strtree = None
+        self._records.append(data)
+        self._positions[data['file']] = pos
+        return pos, _bounds(data['polygon'])
+
+
+    def _geometry(self, pos):
+        # geometries are constructed on first use
+        res = self._geometries.get(pos)
+        if res is None:
+            res = geometry.Polygon(self._records.coords(pos))
+            self._geometries.put(pos, res)
+
+        return res
+
+
+    def _geometry_array(self, positions):
+        """Shapely polygons at given positions
+
+        Polygons missing in the cache are constructed with one
+        vectorised call.
+
+        :positions: array of positions
+
+        :return: numpy array of polygons
+        """
+        res = np.empty(len(positions), dtype = object)
+        missing = []
+        for i, pos in enumerate(positions):
+            res[i] = self._geometries.get(pos)
+            if res[i] is None:
+                missing += [i]
+
+        if not missing:
+            return res
+
+        coords = [np.asarray(self._records.coords(positions[i]),
+                             dtype = float).reshape(-1, 2) \
+                  for i in missing]
+        rings = shapely.linearrings\
+            (np.concatenate(coords),
+             indices = np.repeat(np.arange(len(coords)),
+                                 [len(x) for x in coords]))
+        res[missing] = shapely.polygons(rings)
+
+        for i in missing:
+            self._geometries.put(positions[i], res[i])
+
+        return res
+
+
+    def _new_index(self, records):
+        return Polygon_File_Index\
+            (records, compact = self._compact,
+             geometry_cache = self._geometry_cache)
+
+
+    def _bulk_load(self, records):
+        """Load records into the index
+
+        R-tree is bulk loaded if the index is empty
+
+        :records: iterable of data
+
+        """
+        def stream():
+            for data in records:
+                self._check_data(data)
+
+                if data['file'] in self._positions:
+                    continue
+
+                pos, bounds = self._append(data)
+                yield pos, bounds, None
+
+        if self._positions:
+            self._writable()
+            self._changed()
+            for pos, bounds, _ in stream():
+                self._rtree.insert(pos, bounds)
+            return
+
+        # rtree does not accept an empty stream
+        items = stream()
+        first = next(items, None)
+        if first is None:
+            return
+
+        self._path = None
+        self._rtree = index.Index\
+            (itertools.chain([first], items))
+
+
+    def _view(self, mask):
+        # views share data with this index
+        res = Polygon_File_Index.__new__(Polygon_File_Index)
+        res.__dict__.update(self.__dict__)
+        res._mask = mask
+        res._mask_size = int(mask.sum())
+        res._view_version = self._version[0]
+        return res
+
+
+    def _changed(self):
+        self._version[0] += 1
+
+
+    def _check_view(self):
+        if self._mask is not None \
+           and self._view_version != self._version[0]:
+            raise RuntimeError("the index of this view has changed")
+
+
+    def _in_view(self, positions):
+        self._check_view()
+        if self._mask is None:
+            return np.ones(len(positions), dtype = bool)
+
+        res = positions < len(self._mask)
+        res[res] = self._mask[positions[res]]
+        return res
+
+
+    def _writable(self):
+        # a view becomes an index of its own before the first change
+        if self._mask is not None:
+            self.__init__(list(self.iterate()), compact = self._compact,
+                          geometry_cache = self._geometry_cache)
+
+
+    def _record_bounds(self):
+        # bounds of all records, as (n, 4) array or an iterable
+        if isinstance(self._records, Packed_Records) \
+           and not self._records.changed():
+            return self._records.bounds()
+
+        return (_bounds(self._records.coords(pos)) \
+                for pos in range(len(self._records)))
+
+
+    def _new_rtree(self):
+        # bulk loaded from bounds of all records
+        if not len(self._records):
+            return index.Index()
+
+        return index.Index((pos, tuple(x), None) \
+                           for pos, x in enumerate(self._record_bounds()))
 
 
     def _check_data(self, data):
@@ -42,15 +244,14 @@ class Polygon_File_Index:
 
         """
         self._check_data(data)
+        self._writable()
 
-        if data['file'] in self._polygons:
+        if data['file'] in self._positions:
             return
 
-        pl = geometry.Polygon(data['polygon'])
-        self._polygons[data['file']] = pl
-        self._rtree.insert(hash_string(data['file']),
-                           pl.bounds,
-                           obj = data)
+        self._changed()
+        pos, bounds = self._append(data)
+        self._rtree.insert(pos, bounds)
 
 
     def update(self, data):
@@ -60,18 +261,34 @@ class Polygon_File_Index:
 
         """
         self._check_data(data)
+        self._writable()
 
-        if data['file'] not in self._polygons:
+        if data['file'] not in self._positions:
             self.insert(data)
             return True
 
-        pl = self._polygons[data['file']]
-        if pl.almost_equals(geometry.Polygon(data['polygon'])):
+        pos = self._positions[data['file']]
+        pl = self._geometry(pos)
+        # same as almost_equals from shapely<2
+        if pl.equals_exact(geometry.Polygon(data['polygon']), 5e-7):
             return False
 
-        self._rtree.delete(hash_string(data['file']), pl.bounds)
-        del self._polygons[data['file']]
-        self.insert(data)
+        # the record keeps its position, views made before would see
+        # the new record
+        self._changed()
+        self._strtree = None
+        self._records[pos] = data
+        self._columns.update(pos)
+        self._geometries.pop(pos)
+
+        self._updates += 1
+        if self._updates < len(self._records):
+            self._rtree.delete(pos, pl.bounds)
+            self._rtree.insert(pos, _bounds(data['polygon']))
+        else:
+            self._updates = 0
+            self._rtree = self._new_rtree()
+
         return True
 
 
@@ -84,10 +301,77 @@ class Polygon_File_Index:
         https://shapely.readthedocs.io/en/latest/manual.html#points
 
         """
-        for data in self._rtree.nearest(point, 1, objects='raw'):
-            if self._polygons[data['file']]\
-                   .intersects(geometry.Point(point)):
-                yield data
+        self._check_view()
+        for pos in self._rtree.nearest(point, 1):
+            if self._mask is not None \
+               and not self._in_view(np.array([pos]))[0]:
+                continue
+            if self._geometry(pos).intersects(geometry.Point(point)):
+                yield self._records[pos]
+
+
+    def _point_tree(self):
+        # the tree holds bounding boxes, so that polygons are
+        # constructed only for candidates (see geometry_cache)
+        if self._strtree is None:
+            positions = np.fromiter(self._positions.values(),
+                                    dtype = np.int64,
+                                    count = len(self._positions))
+            files = np.array(list(self._positions.keys()),
+                             dtype = object)
+            bounds = np.array(list(self._record_bounds()),
+                              dtype = float).reshape(-1, 4)
+            self._strtree = (shapely.STRtree\
+                             (shapely.box(*bounds[positions].T)),
+                             positions, files)
+
+        return self._strtree
+
+
+    def locate_many(self, points, return_indices = False):
+        """Find all index data that contain given points
+
+        Unlike nearest, every polygon containing a point is found,
+        points on a polygon boundary are included. Points are queried
+        with one call against a shapely STRtree of bounding boxes of
+        all polygons, the tree is kept until the index is
+        changed. Polygons of candidates are then tested with one
+        vectorised call.
+
+        :points: (n, 2) array of point coordinates, with the same
+        convention as used in .insert for polygon tuples
+
+        :return_indices: if True, return arrays instead of data
+
+        :return: list of n lists of data, or a tuple of two arrays of
+        equal length: indices of points and their 'file' fields
+        """
+        points = np.asarray(points, dtype = float).reshape(-1, 2)
+        if not self._positions:
+            if return_indices:
+                return np.zeros(0, np.int64), np.zeros(0, object)
+            return [[] for _ in range(len(points))]
+
+        tree, positions, files = self._point_tree()
+        with metrics.timer('polygon_index_locate_seconds'):
+            idx, found = tree.query(shapely.points(points))
+            sel = shapely.intersects_xy\
+                (self._geometry_array(positions[found]),
+                 points[idx, 0], points[idx, 1])
+            idx, found = idx[sel], found[sel]
+        metrics.inc('polygon_index_points', len(points))
+        if self._mask is not None:
+            sel = self._in_view(positions[found])
+            idx, found = idx[sel], found[sel]
+
+        if return_indices:
+            return idx, files[found]
+
+        found = positions[found]
+        res = [[] for _ in range(len(points))]
+        for i, pos in zip(idx.tolist(), found.tolist()):
+            res[i] += [self._records[pos]]
+        return res
 
 
     def intersect(self, polygon):
@@ -97,45 +381,86 @@ class Polygon_File_Index:
 
         :return: smaller Polygon_File_Index
         """
-        res = Polygon_File_Index()
         polygon = geometry.Polygon(polygon)
+        shapely.prepare(polygon)
+
+        positions = np.fromiter(self._rtree.intersection(polygon.bounds),
+                                dtype = np.int64)
+        positions = positions[self._in_view(positions)]
+        metrics.inc('polygon_index_candidates', len(positions))
+        geoms = self._geometry_array(positions)
+        mask = shapely.intersects(polygon, geoms)
+        positions = positions[mask]
+        schnitt = shapely.intersection(polygon, geoms[mask])
+
+        # only non-empty polygon intersections are kept
+        mask = (shapely.get_type_id(schnitt) == \
+                shapely.GeometryType.POLYGON) \
+                & ~shapely.is_empty(schnitt)
+        positions = positions[mask]
+        coords, idx = shapely.get_coordinates\
+            (shapely.get_exterior_ring(schnitt[mask]),
+             return_index = True)
+        coords = coords.tolist()
+        splits = np.concatenate\
+            ([[0], np.flatnonzero(np.diff(idx)) + 1, [len(coords)]])
+
+        res = []
+        for pos, a, b in zip(positions, splits[:-1], splits[1:]):
+            new_data = dict(self._records[pos])
+            new_data.update({'polygon': \
+                             list(map(tuple, coords[a:b]))})
+            res += [new_data]
+        metrics.inc('polygon_index_results', len(res))
 
-        if not self._rtree.get_size():
-            return res
+        return self._new_index(res)
 
-        for data in self._rtree.intersection(polygon.bounds,
-                                             objects='raw'):
-            schnitt = polygon.intersection\
-                (self._polygons[data['file']])
 
-            if schnitt.is_empty \
-               or not isinstance(schnitt, geometry.Polygon):
-                continue
+    def _alive(self):
+        self._check_view()
+        if self._mask is not None:
+            return self._mask.copy()
 
-            new_data = data
-            new_data.update({'polygon': \
-                             list(schnitt.exterior.coords)})
-            res.insert(new_data)
+        return np.ones(len(self._records), dtype = bool)
 
-        return res
 
+    def filter(self, how = None, where = None):
+        """Filter index data
 
-    def filter(self, how = lambda x: True):
-        res = Polygon_File_Index()
+        :how: an optional function of data returning bool
 
-        if not self._rtree.get_size():
-            return res
+        :where: an optional list of predicates (field, op, value),
+        all of them must hold. op is one of '==', '!=', '<', '<=', '>',
+        '>=', 'in', 'not in'. Predicates are evaluated on columns of
+        record fields as numpy arrays (see Record_Columns), before how
+        is called. Records without the field never match.
 
-        for data in self._rtree.intersection\
-            (self._rtree.bounds, objects='raw'):
-            if how(data):
-                res.insert(data)
+        :return: a view on this index. Views share data and the R-tree
+        with the index, a view is copied to an index of its own on
+        its first change. After a change of this index, views raise
+        RuntimeError.
+        """
+        mask = self._alive()
+        for field, op, value in where or []:
+            mask &= self._columns.match(field, op, value)
 
-        return res
+        if how is not None:
+            for pos in np.flatnonzero(mask):
+                mask[pos] = how(self._records[pos])
+
+        return self._view(mask)
 
 
     def size(self):
-        return self._rtree.get_size()
+        self._check_view()
+        if self._mask is not None:
+            return self._mask_size
+
+        return len(self._positions)
+
+
+    def __len__(self):
+        return self.size()
 
 
     def save(self, fn):
@@ -145,14 +470,13 @@ class Polygon_File_Index:
 
         """
         data = []
-        for x in self._rtree.intersection(self._rtree.bounds,
-                                          objects = True):
-            data += [{'id': x.id,
-                      'bbox': x.bbox,
-                      'object': x.object}]
+        for pos in self._scan():
+            data += [{'id': pos,
+                      'bbox': list(_bounds(self._records.coords(pos))),
+                      'object': self._records[pos]}]
 
         with open(fn, 'w') as f:
-            json.dump(data, f)
+            json.dump(data, f, default = json_default)
 
 
     def load(self, fn):
@@ -162,28 +486,87 @@ class Polygon_File_Index:
 
         """
         with open(fn, 'r') as f:
-            for x in json.load(f):
-                try:
-                    self._check_data(x['object'])
-                except:
-                    continue
+            data = json.load(f)
+
+        def valid(x):
+            try:
+                self._check_data(x['object'])
+            except:
+                return False
+            return True
+
+        self._bulk_load(x['object'] for x in data if valid(x))
+
+
+    def save_binary(self, path):
+        """Save index to a directory in a binary format
+
+        The directory contains arrays of packed records (see
+        polygon_records.py), including their bounding boxes.
+
+        :path: path to a directory
+
+        """
+        if self._path is not None and \
+           os.path.realpath(path) == os.path.realpath(self._path):
+            raise RuntimeError("cannot overwrite files of an opened index")
+
+        records = pack_records(self.iterate())
+        records.save(path)
+
+        # R-tree files written by older versions
+        fn = os.path.join(path, 'rtree')
+        remove_file(fn + '.dat')
+        remove_file(fn + '.idx')
+
 
-                self._rtree.insert\
-                    (x['id'], x['bbox'],
-                     obj = x['object'])
-                self._polygons[x['object']['file']] = \
-                    geometry.Polygon(x['object']['polygon'])
+    def load_binary(self, path):
+        """Load index saved with save_binary
+
+        Files are memory-mapped, data and polygons are constructed on
+        first access. The R-tree is bulk loaded in memory from the
+        saved bounding boxes, saved files are never modified. If the
+        index is not empty, data is copied into the index.
+
+        :path: path to a directory
+
+        """
+        records = load_records(path)
+
+        if self._positions or not len(records):
+            self._bulk_load(records)
+            return
+
+        self._changed()
+        self._records = records
+        self._columns = Record_Columns(records)
+        self._positions = {x: i for i, x in enumerate(records.files())}
+        self._geometries = LRU_Cache(maxsize = self._geometry_cache)
+        self._strtree = None
+        self._rtree = self._new_rtree()
+        self._path = path
+
+
+    def _scan(self):
+        # positions in insertion order
+        self._check_view()
+        if self._mask is not None:
+            return np.flatnonzero(self._mask).tolist()
+
+        return range(len(self._records))
 
 
     def files(self, what = 'file'):
         """Generator for files
 
         """
-        if not self._rtree.get_size():
-            yield from ()
+        if what == 'file' and self._compact:
+            files = self._records.files()
+            for pos in self._scan():
+                yield files[pos]
+            return
 
-        for data in self._rtree.intersection(self._rtree.bounds,
-                                             objects = 'raw'):
+        for data in self.iterate():
             if what in data:
                 yield data[what]
             else:
@@ -191,9 +574,8 @@ class Polygon_File_Index:
 
 
     def iterate(self):
-        if not self._rtree.get_size():
-            yield from ()
+        """Generator for data in insertion order
 
-        for data in self._rtree.intersection(self._rtree.bounds,
-                                             objects = 'raw'):
-            yield data
+        """
+        for pos in self._scan():
+            yield self._records[pos]
@@ -1,4 +1,5 @@
 import os
+import shutil
 
 from cassandra_io.polygon_index \
     import Polygon_File_Index
@@ -62,3 +63,203 @@ def test_polygon_index_update():
                  'polygon': [(2,2),(2,3),(3,3),(3,2)]})
     assert 0 == len(list(x.nearest((0.5,0.5))))
     assert 1 == len(list(x.nearest((2.5,2.5))))
+
+
+def test_polygon_index_bulk():
+    data = [{'file': str(i),
+             'polygon': [(i,0),(i,1),(i+1,1),(i+1,0)]} \
+            for i in range(100)]
+    data += [{'file': '0', 'polygon': [(5,5),(5,6),(6,6),(6,5)]}]
+
+    x = Polygon_File_Index(data)
+    assert 100 == x.size()
+    assert 2 == len(list(x.nearest((10,0.5))))
+    assert 0 == len(list(x.nearest((5.5,5.5))))
+    assert 50 == x.filter(how = lambda x: int(x['file']) < 50).size()
+    assert 0 == x.filter(how = lambda x: False).size()
+    assert 2 == x.intersect([(10,0),(10,1),(12,1),(12,0)]).size()
+    assert 0 == Polygon_File_Index([]).size()
+
+
+def test_polygon_index_save_load_binary():
+    data = [{'file': str(i),
+             'polygon': [(i,0),(i,1),(i+1,1),(i+1,0)],
+             'year': 2000 + i} \
+            for i in range(100)]
+    x = Polygon_File_Index(data)
+
+    try:
+        x.save_binary('test_polygon_index')
+        saved = {fn: open(os.path.join('test_polygon_index', fn),
+                          'rb').read() \
+                 for fn in os.listdir('test_polygon_index')}
+        y = Polygon_File_Index()
+        y.load_binary('test_polygon_index')
+        assert 100 == y.size()
+        assert set(x.files()) == set(y.files())
+        assert set(x.files('year')) == set(y.files('year'))
+        assert 2 == len(list(y.nearest((10,0.5))))
+        assert 2 == y.intersect([(10,0),(10,1),(12,1),(12,0)]).size()
+        assert all(type(x['polygon']) is list for x in y.iterate())
+        assert all(type(x['polygon']) is list \
+                   for x in y.nearest((10,0.5)))
+
+        # changes are not written to the saved files
+        y.insert({'file': 'new', 'polygon': [(0,5),(0,6),(1,6),(1,5)]})
+        assert y.update({'file': '0',
+                         'polygon': [(0,7),(0,8),(1,8),(1,7)]})
+        assert 1 == len(list(y.nearest((0.5,7.5))))
+        assert 101 == y.size()
+
+        # queries and changes do not write to the saved files
+        assert saved == {fn: open(os.path.join('test_polygon_index', fn),
+                                  'rb').read() \
+                         for fn in os.listdir('test_polygon_index')}
+        z = Polygon_File_Index()
+        z.load_binary('test_polygon_index')
+        assert 100 == z.size()
+        assert 0 == len(list(z.nearest((0.5,7.5))))
+
+        # loading into a non-empty index copies data
+        y.load_binary('test_polygon_index')
+        assert 101 == y.size()
+
+        Polygon_File_Index().save_binary('test_polygon_index')
+        z = Polygon_File_Index()
+        z.load_binary('test_polygon_index')
+        assert 0 == z.size()
+    finally:
+        shutil.rmtree('test_polygon_index', ignore_errors = True)
+
+
+def test_polygon_index_compact():
+    data = [{'file': str(i),
+             'polygon': [(i,0),(i,1),(i+1,1),(i+1,0)],
+             'year': 2000 + i} \
+            for i in range(100)]
+    x = Polygon_File_Index(data, compact = True, geometry_cache = 10)
+    x.insert({'file': 'new', 'polygon': [(0,5),(0,6),(1,6),(1,5)]})
+
+    assert 101 == x.size()
+    assert 2 == len(list(x.nearest((10,0.5))))
+    assert 1 == len(list(x.nearest((0.5,5.5))))
+    assert set(range(2000, 2100)) == \
+        set(x.filter(lambda x: 'year' in x).files('year'))
+    y = x.intersect([(10,0),(10,1),(12,1),(12,0)])
+    assert 2 == y.size()
+    assert y._compact
+
+    assert x.update({'file': '0', 'polygon': [(0,7),(0,8),(1,8),(1,7)]})
+    assert not x.update({'file': '0',
+                         'polygon': [(0,7),(0,8),(1,8),(1,7)]})
+    assert 1 == len(list(x.nearest((0.5,7.5))))
+    assert 101 == x.size()
+    assert len(x._geometries) <= 10
+
+
+def test_polygon_index_locate_many():
+    data = [{'file': str(i),
+             'polygon': [(i,0),(i,1),(i+1,1),(i+1,0)]} \
+            for i in range(100)]
+    data += [{'file': 'big', 'polygon': [(0,0),(0,1),(50,1),(50,0)]}]
+    x = Polygon_File_Index(data)
+
+    points = [(0.5,0.5),(60.5,0.5),(10,0.5),(0.5,5)]
+    res = x.locate_many(points)
+    assert 4 == len(res)
+    assert {'0','big'} == set(y['file'] for y in res[0])
+    assert ['60'] == [y['file'] for y in res[1]]
+    assert {'9','10','big'} == set(y['file'] for y in res[2])
+    assert [] == res[3]
+
+    x.update({'file': 'big', 'polygon': [(0,5),(0,6),(1,6),(1,5)]})
+    idx, files = x.locate_many(points, return_indices = True)
+    assert [0,1,2,2,3] == sorted(idx.tolist())
+    assert 'big' == files[idx == 3][0]
+    assert [[]] == Polygon_File_Index().locate_many([(0,0)])
+
+    # only polygons of candidates are constructed
+    x = Polygon_File_Index(data, compact = True, geometry_cache = 10)
+    assert ['60'] == [y['file'] for y in x.locate_many([(60.5,0.5)])[0]]
+    assert len(x._geometries) <= 10
+
+
+def test_polygon_index_filter_where():
+    data = [{'file': str(i),
+             'polygon': [(i,0),(i,1),(i+1,1),(i+1,0)],
+             'year': 2000 + i,
+             'kind': 'odd' if i % 2 else 'even'} \
+            for i in range(100)]
+    data += [{'file': 'plain', 'polygon': [(0,5),(0,6),(1,6),(1,5)]}]
+
+    for compact in (False, True):
+        x = Polygon_File_Index(data, compact = compact)
+        y = x.filter(where = [('year', '>=', 2010),
+                              ('year', '<', 2020)])
+        assert 10 == y.size()
+        assert set(range(2010, 2020)) == set(y.files('year'))
+        assert 5 == y.filter(where = [('kind', '==', 'odd')]).size()
+        assert 2 == x.filter(where = [('file', 'in', ['3', 'plain',
+                                                      'none'])]).size()
+        assert 100 == x.filter(where = [('kind', '!=', 'all')]).size()
+        assert 1 == x.filter(how = lambda x: 'year' not in x).size()
+        assert 25 == x.filter(lambda x: int(x['file']) < 50,
+                              [('kind', '==', 'odd')]).size()
+
+        # views use the R-tree of the index
+        assert 2 == y.intersect([(10,0),(10,1),(12,1),(12,0)]).size()
+        assert 1 == len(list(y.nearest((10.5,0.5))))
+        assert 0 == len(list(y.nearest((5.5,0.5))))
+        idx, files = y.locate_many([(5.5,0.5),(15.5,0.5)],
+                                   return_indices = True)
+        assert ['15'] == files.tolist()
+
+        # and are copied on change
+        y.insert({'file': 'new', 'polygon': [(0,7),(0,8),(1,8),(1,7)]})
+        assert 11 == y.size()
+        assert 101 == x.size()
+        assert 'new' not in set(x.files())
+
+        # views refuse to work after a change of the index
+        z = x.filter(where = [('kind', '==', 'odd')])
+        x.insert({'file': 'other', 'polygon': [(0,9),(0,10),(1,10),(1,9)]})
+        try:
+            z.size()
+            assert False
+        except RuntimeError:
+            pass
+
+
+def test_polygon_index_order():
+    data = [{'file': str(i),
+             'polygon': [(i,0),(i,1),(i+1,1),(i+1,0)],
+             'year': 2000 + i} \
+            for i in reversed(range(100))]
+
+    for compact in (False, True):
+        x = Polygon_File_Index(data, compact = compact)
+        assert 100 == len(x)
+        assert [y['file'] for y in data] == list(x.files())
+
+        # updated records keep their position
+        for i in range(250):
+            assert x.update({'file': '50', 'year': i,
+                             'polygon': [(i,5),(i,6),(i+1,6),(i+1,5)]})
+        assert 100 == len(x)
+        assert 100 == len(x._records)
+        assert [y['file'] for y in data] == list(x.files())
+        assert ['50'] == list(x.filter(where = [('year', '==', 249)])\
+                              .files())
+        assert 0 == len(list(x.nearest((50.5,0.5))))
+        assert 1 == len(list(x.nearest((249.5,5.5))))
+        assert 99 == x.intersect([(0,0),(0,1),(100,1),(100,0)]).size()
+
+        # in place updates invalidate views
+        y = x.filter(where = [('year', '==', 249)])
+        x.update({'file': '50', 'year': 0,
+                  'polygon': [(0,5),(0,6),(1,6),(1,5)]})
+        try:
+            list(y.iterate())
+            assert False
+        except RuntimeError:
+            pass
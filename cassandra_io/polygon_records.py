@@ -0,0 +1,356 @@
+import os
+import json
+
+import numpy as np
+
+from array import array
+
+from cassandra_io.utils import json_default
+
+
+class Data_Records(list):
+    """Records kept as data dictionaries
+
+    """
+
+    def coords(self, i):
+        return self[i]['polygon']
+
+
+class Packed_Records:
+    """Records with polygon coordinates packed in contiguous arrays
+
+    Coordinates of all polygons are stored in one (n, 2) array, the
+    remaining fields are stored as json text. The arrays can be
+    memory-mapped from files written with 'save', in which case data
+    dictionaries are only decoded on access. Decoded data have
+    polygons as lists of coordinate lists, as data decoded from json
+    text, and do not refer to the arrays.
+
+    Appended records are packed into growable in-memory buffers,
+    changed records are kept as data. Files are never modified.
+
+    """
+
+    def __init__(self, coords = None, offsets = None,
+                 attrs = None, attrs_offsets = None, files = None):
+        """
+        :coords: (n, 2) array of polygon coordinates
+
+        :offsets: array of n+1 offsets of polygons in coords
+
+        :attrs: uint8 array of json encoded fields
+
+        :attrs_offsets: array of n+1 offsets in attrs
+
+        :files: list of n 'file' fields
+
+        Without arguments, an empty container is created.
+        """
+        if files is None:
+            coords, attrs = np.zeros((0, 2)), np.zeros(0, np.uint8)
+            offsets = attrs_offsets = np.zeros(1, np.int64)
+            files = []
+
+        self._coords = coords
+        self._offsets = offsets
+        self._attrs = attrs
+        self._attrs_offsets = attrs_offsets
+        self._files = list(files)
+        self._n = len(files)
+
+        # appended records: flat coordinates and json fields
+        self._new_coords = array('d')
+        self._new_offsets = array('q', [0])
+        self._new_attrs = bytearray()
+        self._new_attrs_offsets = array('q', [0])
+
+        # pos -> data or None for changed or deleted records
+        self._overlay = {}
+
+
+    def __len__(self):
+        return len(self._files)
+
+
+    def __getitem__(self, i):
+        if i in self._overlay:
+            return self._overlay[i]
+
+        if i < self._n:
+            attrs = self._attrs[self._attrs_offsets[i]:\
+                                self._attrs_offsets[i+1]]
+        else:
+            j = i - self._n
+            attrs = self._new_attrs[self._new_attrs_offsets[j]:\
+                                    self._new_attrs_offsets[j+1]]
+
+        res = json.loads(bytes(attrs).decode('utf-8'))
+        res['polygon'] = self.coords(i).tolist()
+        return res
+
+
+    def __setitem__(self, i, data):
+        self._overlay[i] = data
+
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+    def append(self, data):
+        coords = np.asarray(data['polygon'], dtype = float)
+        self._new_coords.frombytes(coords.reshape(-1, 2).tobytes())
+        self._new_offsets.append(len(self._new_coords) // 2)
+
+        x = dict(data)
+        x['polygon'] = None
+        self._new_attrs += json.dumps(x, default = json_default)\
+                               .encode('utf-8')
+        self._new_attrs_offsets.append(len(self._new_attrs))
+        self._files.append(data['file'])
+
+
+    def coords(self, i):
+        """Polygon coordinates of a record
+
+        :return: an array view for the packed records
+        """
+        if i in self._overlay:
+            return self._overlay[i]['polygon']
+
+        if i < self._n:
+            return self._coords[self._offsets[i]:self._offsets[i+1]]
+
+        # slicing copies, so that buffers are never exported
+        j = i - self._n
+        return np.frombuffer\
+            (self._new_coords[2*self._new_offsets[j]:\
+                              2*self._new_offsets[j+1]],
+             dtype = float).reshape(-1, 2)
+
+
+    def files(self):
+        """List of 'file' fields by position
+
+        """
+        return self._files
+
+
+    def changed(self):
+        """True if records were appended or changed after creation
+
+        """
+        return len(self._files) > self._n or bool(self._overlay)
+
+
+    def bounds(self):
+        """Bounds of the packed polygons
+
+        :return: (n, 4) array of (minx, miny, maxx, maxy)
+        """
+        if not self._n:
+            return np.zeros((0, 4))
+
+        start = self._offsets[:-1]
+        return np.stack\
+            ([np.minimum.reduceat(self._coords[:,0], start),
+              np.minimum.reduceat(self._coords[:,1], start),
+              np.maximum.reduceat(self._coords[:,0], start),
+              np.maximum.reduceat(self._coords[:,1], start)],
+             axis = 1)
+
+
+    def save(self, path):
+        """Save packed records to a directory
+
+        Only records given on creation are saved, use pack_records
+        to save appended or changed records.
+
+        :path: path to a directory
+
+        """
+        os.makedirs(path, exist_ok = True)
+
+        np.save(os.path.join(path, 'coords.npy'), self._coords)
+        np.save(os.path.join(path, 'offsets.npy'), self._offsets)
+        np.save(os.path.join(path, 'attrs.npy'), self._attrs)
+        np.save(os.path.join(path, 'attrs_offsets.npy'),
+                self._attrs_offsets)
+        with open(os.path.join(path, 'files.json'), 'w') as f:
+            json.dump(self._files, f)
+
+
+def pack_records(records):
+    """Pack data dictionaries
+
+    :records: iterable of data dictionaries with 'file' and 'polygon'
+    fields
+
+    :return: Packed_Records
+    """
+    coords, attrs, files = [], [], []
+    for data in records:
+        coords += [np.asarray(data['polygon'], dtype = float)\
+                   .reshape(-1, 2)]
+        files += [data['file']]
+
+        # keep the order of keys
+        x = dict(data)
+        x['polygon'] = None
+        attrs += [json.dumps(x, default = json_default)\
+                  .encode('utf-8')]
+
+    offsets = np.cumsum([0] + [len(x) for x in coords],
+                        dtype = np.int64)
+    attrs_offsets = np.cumsum([0] + [len(x) for x in attrs],
+                              dtype = np.int64)
+
+    if coords:
+        coords = np.concatenate(coords)
+    else:
+        coords = np.zeros((0, 2))
+
+    return Packed_Records\
+        (coords = coords, offsets = offsets,
+         attrs = np.frombuffer(b''.join(attrs), dtype = np.uint8),
+         attrs_offsets = attrs_offsets,
+         files = files)
+
+
+def load_records(path, mmap_mode = 'r'):
+    """Load packed records saved with Packed_Records.save
+
+    :path: path to a directory
+
+    :mmap_mode: passed to numpy.load. None reads arrays into memory
+
+    :return: Packed_Records
+    """
+    def load(name):
+        return np.load(os.path.join(path, name),
+                       mmap_mode = mmap_mode)
+
+    with open(os.path.join(path, 'files.json'), 'r') as f:
+        files = json.load(f)
+
+    return Packed_Records\
+        (coords = load('coords.npy'),
+         offsets = load('offsets.npy'),
+         attrs = load('attrs.npy'),
+         attrs_offsets = load('attrs_offsets.npy'),
+         files = files)
+
+
+def _column_array(values):
+    present = np.array([x is not None for x in values], dtype = bool)
+    given = [x for x in values if x is not None]
+
+    if all(isinstance(x, (int, float, np.number)) for x in given):
+        return np.array([0 if x is None else x for x in values]), \
+            present
+    if all(isinstance(x, str) for x in given):
+        return np.array(['' if x is None else x for x in values],
+                        dtype = str), present
+
+    res = np.empty(len(values), dtype = object)
+    res[:] = values
+    return res, present
+
+
+_OPERATORS = {'==': np.equal, '!=': np.not_equal,
+              '<': np.less, '<=': np.less_equal,
+              '>': np.greater, '>=': np.greater_equal}
+
+
+class Record_Columns:
+    """Record fields as numpy arrays
+
+    A column is built from the records on first use and extended
+    with appended records later. Changed records are reported with
+    update.
+
+    """
+
+    def __init__(self, records):
+        self._records = records
+        # field -> list of values, (values, present) arrays
+        self._values = {}
+        self._arrays = {}
+
+
+    def column(self, field):
+        """Values of a field by position
+
+        :return: values array and a bool array, False for records
+        without the field, with None value or replaced by None
+        """
+        values = self._values.setdefault(field, [])
+        n = len(self._records)
+        if field in self._arrays and len(values) == n:
+            return self._arrays[field]
+
+        for i in range(len(values), n):
+            data = self._records[i]
+            values.append(None if data is None else data.get(field))
+
+        self._arrays[field] = _column_array(values)
+        return self._arrays[field]
+
+
+    def update(self, pos):
+        """Take a changed record into account
+
+        :pos: position of the record
+
+        """
+        data = self._records[pos]
+        for field, values in self._values.items():
+            if pos < len(values):
+                values[pos] = None if data is None else data.get(field)
+                self._arrays.pop(field, None)
+
+
+    def match(self, field, op, value):
+        """Evaluate a predicate on a field
+
+        :op: one of '==', '!=', '<', '<=', '>', '>=', 'in', 'not in'
+
+        :return: bool array by position, records without the field
+        never match
+        """
+        values, present = self.column(field)
+
+        if values.dtype == object:
+            # mixed types, compared one by one
+            if op in ('in', 'not in'):
+                value = list(value)
+                fun = (lambda x: x in value) if op == 'in' \
+                    else (lambda x: x not in value)
+            elif op in _OPERATORS:
+                fun = lambda x: bool(_OPERATORS[op](x, value))
+            else:
+                raise RuntimeError("unknown operator: %s" % op)
+
+            def test(x):
+                try:
+                    return fun(x)
+                except TypeError:
+                    return False
+
+            res = np.array([test(x) for x in values], dtype = bool)
+        elif op in ('in', 'not in'):
+            res = np.isin(values, list(value),
+                          invert = (op == 'not in'))
+        elif op in _OPERATORS:
+            try:
+                res = _OPERATORS[op](values, value)
+            except TypeError:
+                res = np.zeros(len(values), dtype = bool)
+            if not isinstance(res, np.ndarray):
+                res = np.full(len(values), bool(res))
+        else:
+            raise RuntimeError("unknown operator: %s" % op)
+
+        return res & present
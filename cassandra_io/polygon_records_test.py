@@ -0,0 +1,36 @@
+import shutil
+
+import numpy as np
+
+from cassandra_io.polygon_records import \
+    pack_records, load_records
+
+
+def test_pack_records():
+    data = [{'file': str(i),
+             'polygon': [(i,0),(i,1),(i+1,1),(i+1,0)],
+             'year': 2000 + i} \
+            for i in range(10)]
+    x = pack_records(data)
+
+    try:
+        x.save('test_polygon_records')
+        y = load_records('test_polygon_records')
+
+        assert 10 == len(y)
+        assert [x['file'] for x in data] == y.files()
+        assert list(data[3].keys()) == list(y[3].keys())
+        assert np.array_equal(data[3]['polygon'], y.coords(3))
+        # data have polygons as lists, as decoded json
+        assert [[3,0],[3,1],[4,1],[4,0]] == y[3]['polygon']
+        assert type(y[3]['polygon'][0][0]) is float
+        assert np.array_equal([[3,0,4,1]], y.bounds()[3:4])
+
+        y[3] = None
+        y.append(data[3])
+        assert y[3] is None
+        assert 11 == len(y)
+        assert data[3]['year'] == y[10]['year']
+        assert np.array_equal(data[3]['polygon'], y.coords(10))
+    finally:
+        shutil.rmtree('test_polygon_records', ignore_errors = True)
@@ -0,0 +1,223 @@
+import os
+import json
+import uuid
+import shutil
+import itertools
+
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor
+
+from shapely import geometry
+
+from cassandra_io.polygon_index import Polygon_File_Index, _bounds
+
+
+# shards opened in a worker process: path -> (build, Polygon_File_Index)
+_SHARDS = {}
+
+
+def _open_shard(path, build):
+    # shards of an older build at the same path are replaced
+    if path not in _SHARDS or _SHARDS[path][0] != build:
+        idx = Polygon_File_Index(compact = True)
+        idx.load_binary(path)
+        _SHARDS[path] = (build, idx)
+
+    return _SHARDS[path][1]
+
+
+def _intersect_shard(path, build, polygon):
+    return list(_open_shard(path, build).intersect(polygon).iterate())
+
+
+def _filter_shard(path, build, how, where):
+    return list(_open_shard(path, build).filter(how, where).iterate())
+
+
+def _locate_shard(path, build, points):
+    return _open_shard(path, build).locate_many(points,
+                                                return_indices = True)
+
+
+def _box_intersects(a, b):
+    return a[0] <= b[2] and b[0] <= a[2] \
+        and a[1] <= b[3] and b[1] <= a[3]
+
+
+class Sharded_Polygon_Index:
+
+    def __init__(self, path, processes = None):
+        """A Polygon_File_Index split into spatial shards
+
+        Shards are saved with Polygon_File_Index.save_binary (see
+        build) and queried in parallel by a pool of processes. Each
+        worker memory-maps the shards it needs once, only queries and
+        results are sent between processes.
+
+        :path: directory written with build
+
+        :processes: number of worker processes, None uses the number
+        of cores. With 1, shards are queried in this process.
+
+        """
+        self._path = path
+        self._processes = processes
+        self._pool = None
+
+        with open(os.path.join(path, 'shards.json'), 'r') as f:
+            x = json.load(f)
+        self._build = x['build']
+        self._shards = x['shards']
+
+
+    @staticmethod
+    def build(records, path, shards = None):
+        """Split records into spatial shards and save them
+
+        Records are sorted into vertical stripes of equal size by the
+        x coordinate of their bounding box centers.
+
+        :records: iterable of data (see Polygon_File_Index.insert)
+
+        :path: path to a directory, existing content is replaced. Every
+        build gets a new id, so that worker processes reopen shards
+        rebuilt at the same path
+
+        :shards: number of shards, None uses the number of cores
+
+        """
+        if shards is None:
+            shards = os.cpu_count()
+
+        # unique 'file' fields, same as in Polygon_File_Index
+        data = list(Polygon_File_Index(records).iterate())
+        centers = np.array([sum(_bounds(x['polygon'])[0::2]) / 2 \
+                            for x in data])
+        order = np.argsort(centers, kind = 'stable')
+
+        shutil.rmtree(path, ignore_errors = True)
+        os.makedirs(path)
+
+        res = []
+        for i, part in enumerate(np.array_split(order, shards)):
+            if not len(part):
+                continue
+
+            shard = Polygon_File_Index([data[j] for j in part])
+            fn = 'shard_%d' % i
+            shard.save_binary(os.path.join(path, fn))
+            res += [{'path': fn,
+                     'bounds': list(shard._rtree.bounds),
+                     'size': len(part)}]
+
+        with open(os.path.join(path, 'shards.json'), 'w') as f:
+            json.dump({'build': uuid.uuid4().hex, 'shards': res}, f)
+
+
+    def _map(self, fun, shards, args):
+        """Call fun(shard path, build, *args) for every shard
+
+        :args: list of argument tuples, one per shard
+
+        """
+        calls = [(os.path.join(self._path, x['path']), self._build) + a \
+                 for x, a in zip(shards, args)]
+
+        if self._processes == 1 or len(calls) < 2:
+            return [fun(*x) for x in calls]
+
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor\
+                (max_workers = self._processes)
+
+        futures = [self._pool.submit(fun, *x) for x in calls]
+        return [x.result() for x in futures]
+
+
+    def close(self):
+        """Stop worker processes
+
+        """
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    def size(self):
+        return sum(x['size'] for x in self._shards)
+
+
+    def intersect(self, polygon):
+        """Intersect index with a polygon
+
+        :polygon: list of tuple coordinates
+
+        :return: Polygon_File_Index
+        """
+        bounds = geometry.Polygon(polygon).bounds
+        shards = [x for x in self._shards \
+                  if _box_intersects(x['bounds'], bounds)]
+
+        return Polygon_File_Index\
+            (itertools.chain.from_iterable\
+             (self._map(_intersect_shard, shards,
+                        [(polygon,)] * len(shards))))
+
+
+    def filter(self, how = None, where = None):
+        """Filter index data
+
+        :how: an optional function of data returning bool. It is sent
+        to worker processes, so it must be picklable, e.g. a module
+        level function.
+
+        :where: an optional list of predicates, see
+        Polygon_File_Index.filter
+
+        :return: Polygon_File_Index
+        """
+        return Polygon_File_Index\
+            (itertools.chain.from_iterable\
+             (self._map(_filter_shard, self._shards,
+                        [(how, where)] * len(self._shards))))
+
+
+    def locate_many(self, points):
+        """Find all index data that contain given points
+
+        :points: (n, 2) array of point coordinates
+
+        :return: a tuple of two arrays of equal length: indices of
+        points and their 'file' fields
+        """
+        points = np.asarray(points, dtype = float).reshape(-1, 2)
+
+        # shards only get points within their bounds
+        shards, selected = [], []
+        for x in self._shards:
+            minx, miny, maxx, maxy = x['bounds']
+            sel = np.flatnonzero((points[:,0] >= minx) \
+                                 & (points[:,0] <= maxx) \
+                                 & (points[:,1] >= miny) \
+                                 & (points[:,1] <= maxy))
+            if len(sel):
+                shards += [x]
+                selected += [sel]
+
+        res = self._map(_locate_shard, shards,
+                        [(points[x],) for x in selected])
+
+        if not res:
+            return np.zeros(0, np.int64), np.zeros(0, object)
+
+        return np.concatenate([s[x[0]] for s, x in zip(selected, res)]), \
+            np.concatenate([x[1] for x in res])
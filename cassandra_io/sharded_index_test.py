@@ -0,0 +1,50 @@
+import shutil
+
+from cassandra_io.sharded_index \
+    import Sharded_Polygon_Index
+
+
+def early(data):
+    return data['year'] < 2010
+
+
+def test_sharded_index():
+    data = [{'file': str(i),
+             'polygon': [(i,0),(i,1),(i+1,1),(i+1,0)],
+             'year': 2000 + i} \
+            for i in range(100)]
+
+    try:
+        Sharded_Polygon_Index.build(data, 'test_sharded_index',
+                                    shards = 4)
+        for processes in (1, 2):
+            with Sharded_Polygon_Index('test_sharded_index',
+                                       processes = processes) as x:
+                assert 100 == x.size()
+                assert 4 == len(x._shards)
+
+                # the query crosses a shard border
+                y = x.intersect([(20,0),(20,1),(30,1),(30,0)])
+                assert 10 == y.size()
+                assert set(range(2020, 2030)) == set(y.files('year'))
+                assert 0 == x.intersect([(0,5),(0,6),(1,6)]).size()
+
+                assert 10 == x.filter(early).size()
+                assert 5 == x.filter(where = [('year', '>=', 2095)])\
+                             .size()
+
+                idx, files = x.locate_many([(0.5,0.5),(60.5,0.5),
+                                            (0.5,5)])
+                assert [0,1] == sorted(idx.tolist())
+                assert '60' == files[idx == 1][0]
+
+        # shards opened above in this process are not reused after
+        # a rebuild at the same path
+        Sharded_Polygon_Index.build(data[:10], 'test_sharded_index',
+                                    shards = 4)
+        with Sharded_Polygon_Index('test_sharded_index',
+                                   processes = 1) as x:
+            assert 10 == x.intersect([(0,0),(0,1),(100,1),(100,0)])\
+                          .size()
+    finally:
+        shutil.rmtree('test_sharded_index', ignore_errors = True)
@@ -1,13 +1,26 @@
+import os
 import logging
 import json
+import time
+import uuid
+import shutil
+import itertools
+import collections
 import hashlib
 import geohash
+import shapely
+import numpy as np
 from shapely import geometry
 
-from cassandra import query
+from cassandra import query, \
+    OperationTimedOut, ReadTimeout, ReadFailure, Unavailable
+from cassandra.cluster import NoHostAvailable
 
+from cassandra_io import metrics
 from cassandra_io.base import Cassandra_Base
-from cassandra_io.utils import bbox2hash, bboxes2hash
+from cassandra_io.utils import bbox2hash, bboxes2hash, \
+    hashes_intersect, \
+    pack_data, unpack_data, json_default, LRU_Cache
 
 from cassandra_io.polygon_index import \
     Polygon_File_Index
@@ -19,6 +32,23 @@ def hash_string(string):
     return h.hexdigest()
 
 
+# maximum number of leaf cells of a data entry, that is moved to a
+# deeper level because of crowded cells
+_MAX_CROWDED_CELLS = 64
+
+# failed data requests retried by _iter_rows
+_RETRY_ERRORS = (OperationTimedOut, ReadTimeout, ReadFailure,
+                 Unavailable, NoHostAvailable)
+
+
+# data_log partitions are hours of changes
+_LOG_BUCKET = 3600
+
+# changes logged this many seconds before a snapshot are replayed by
+# refresh, to tolerate clock skew between clients
+_LOG_SKEW = 60
+
+
 def _chunker(seq, size):
     return (seq[pos:pos + size] \
             for pos in range(0, len(seq), size))
@@ -32,7 +62,12 @@ class Cassandra_Spatial_Index(Cassandra_Base):
     """
 
     def __init__(self, hash_min = 2, depth = 3, delta = 1.5,
-                 timeout = 120, **kwargs):
+                 timeout = 120, encoding = 'json',
+                 cache_size = 0, cache_ttl = None,
+                 max_fanout = None, load_concurrency = 128,
+                 load_retries = 3, load_backoff = 0.1,
+                 summary = False, log = False, log_shards = 8,
+                 log_ttl = 7*86400, **kwargs):
         """Init
 
         :hash_min, depth: defines a range of lengths used hash
@@ -41,7 +76,55 @@ class Cassandra_Spatial_Index(Cassandra_Base):
         :delta: determines how larger the geohash box should be when
         splitting data onto subgeohash
 
-        :timeout: cluster session default_timeout
+        :timeout: timeout of requests in seconds
+
+        :encoding: how inserted data is stored. 'json' stores json
+        text, 'float64' or 'float32' store a compact blob with packed
+        polygon coordinates (see utils.pack_data). Data in either
+        format is read back regardless of this option.
+
+        :cache_size: number of geohash cells which query results are
+        kept in memory. 0 disables the cache. Cells are invalidated
+        on inserts made by this instance only, use 'cache_ttl' if
+        other processes write to the same index.
+
+        :cache_ttl: time in seconds a cached cell is valid. None for
+        no expiry
+
+        :max_fanout: number of data entries in a geohash cell, after
+        which inserts go to a deeper level (up to hash_max), unless
+        the data would cover more than 64 cells there. Cell
+        populations are counted in the hash_stats table. None
+        disables counting and the leaf level depends on 'delta' only
+
+        :load_concurrency: number of data requests in flight. Data
+        entries are loaded with one token-aware request each
+
+        :load_retries, load_backoff: number of retries of a failed
+        data request, and the delay in seconds before the first
+        retry, doubled with every retry
+
+        :summary: if True, queries look up occupied leaf cells in the
+        hash_summary table and read them directly, instead of walking
+        the hash levels from hash_min. The summary lists, for every
+        cell of length hash_min, the cells below it that hold data,
+        up to 32**depth rows. Every query reads whole partitions of
+        the cells it covers, which are cached as other cells, so the
+        summary suits sparse data and repeated queries. The summary
+        is maintained regardless of this option (see _prune_summary).
+        The summary of an index created before it existed is filled
+        by rebuild_summary, called on init if this option is set.
+        Until a rebuild is complete, queries walk the hash levels.
+
+        :log: if True, inserts and deletes are recorded in the
+        data_log table, which is needed by refresh. The log write is
+        sent together with the data write
+
+        :log_shards: number of data_log partitions per hour of
+        changes. All clients of an index have to use the same value
+
+        :log_ttl: time in seconds inserts and deletes are kept in the
+        data_log table. None keeps them forever
 
         :kwargs: arguments passed to Cassandra_Base
 
@@ -49,6 +132,22 @@ class Cassandra_Spatial_Index(Cassandra_Base):
         self._hash_min = int(hash_min)
         self._hash_max = int(hash_min + depth)
         self._delta = delta
+        self._max_fanout = max_fanout
+        self._load_concurrency = load_concurrency
+        self._load_retries = load_retries
+        self._load_backoff = load_backoff
+        self._summary = summary
+        self._summary_complete = False
+        self._log = log
+        self._log_shards = int(log_shards)
+        self._log_ttl = log_ttl
+        if encoding not in ('json', 'float64', 'float32'):
+            raise RuntimeError("unknown encoding: %s" % encoding)
+        self._encoding = encoding
+        self._cache = None
+        if cache_size > 0:
+            self._cache = LRU_Cache(maxsize = cache_size,
+                                    ttl = cache_ttl)
         self._datahash_length = len(hash_string(""))
         self._geohash_accuracy = \
             [geohash.decode_exactly('0'*x)[2:] \
@@ -67,16 +166,12 @@ class Cassandra_Spatial_Index(Cassandra_Base):
             % (self._hash_min, self._hash_max)
         super().__init__(**kwargs)
         logging.debug("Cassandra_Spatial_Index: before _cluster.connect")
-        self._session = self._cluster.connect(self._keyspace)
+        self._attach(timeout)
         logging.debug("Cassandra_Spatial_Index: after _cluster.connect")
-        self._session.default_timeout = timeout
-        queries = self._create_tables_queries()
-        for _, query in queries.items():
-            self._session.execute(query)
-        self._queries.update(queries)
-        self._queries.update(self._insert_queries())
-        self._queries.update(self._select_queries())
-        #self._queries.update(self._delete_queries())
+        self._add_prepared(self._insert_queries(),
+                           self._update_queries(),
+                           self._select_queries(),
+                           self._delete_queries())
 
 
     def _create_tables_queries(self):
@@ -87,6 +182,7 @@ class Cassandra_Spatial_Index(Cassandra_Base):
         (
         data_id text,
         data text,
+        packed blob,
         PRIMARY KEY(data_id))"""
 
         for i in range(self._hash_min, self._hash_max + 1):
@@ -98,9 +194,126 @@ class Cassandra_Spatial_Index(Cassandra_Base):
             data_id text,
             PRIMARY KEY(hash, data_id))""" % i
 
+        res['create_hash_stats'] = """
+        CREATE TABLE IF NOT EXISTS
+        hash_stats
+        (
+        hash text,
+        count counter,
+        PRIMARY KEY(hash))"""
+
+        res['create_hash_summary'] = """
+        CREATE TABLE IF NOT EXISTS
+        hash_summary
+        (
+        hash text,
+        level int,
+        leaf text,
+        PRIMARY KEY(hash, level, leaf))"""
+
+        # names of completed migrations of the index data
+        res['create_schema_state'] = """
+        CREATE TABLE IF NOT EXISTS
+        schema_state
+        (
+        name text,
+        PRIMARY KEY(name))"""
+
+        res['create_data_log'] = """
+        CREATE TABLE IF NOT EXISTS
+        data_log
+        (
+        bucket int,
+        shard int,
+        time double,
+        data_id text,
+        deleted boolean,
+        PRIMARY KEY((bucket, shard), time, data_id))
+        WITH compaction = {
+        'class': 'TimeWindowCompactionStrategy',
+        'compaction_window_unit': 'DAYS',
+        'compaction_window_size': 1}"""
+
         return res
 
 
+    def _has_packed_column(self):
+        # data tables created before the packed encoding existed
+        # lack the blob column
+        return 'packed' in self._tables()['data'].columns
+
+
+    def _check_schema(self):
+        super()._check_schema()
+        if not self._has_packed_column():
+            raise RuntimeError("data table lacks the packed column, "
+                               "run ensure_schema")
+
+
+    def ensure_schema(self):
+        tables = self._tables()
+        created = 'data' not in tables
+
+        super().ensure_schema()
+        # the summary of a new index is complete, indices created
+        # before the summary existed are migrated on demand
+        if created:
+            self._mark_complete('summary')
+        elif self._summary and not self._is_complete('summary'):
+            self.rebuild_summary()
+        if self._has_packed_column():
+            return
+
+        self._session.execute\
+            ("""
+            ALTER TABLE data
+            ADD packed blob""")
+
+
+    def _mark_complete(self, name):
+        self._session.execute\
+            ("""
+            INSERT INTO schema_state
+            (name)
+            VALUES (%s)""",
+             [name])
+
+
+    def _is_complete(self, name):
+        return self._session.execute\
+            ("""
+            SELECT name
+            FROM schema_state
+            WHERE name=%s""",
+             [name]).one() is not None
+
+
+    def rebuild_summary(self):
+        """Fill the hash_summary table from the hash tables
+
+        All hash tables are scanned. The summary is marked complete
+        in the schema_state table once the scan is finished, an
+        interrupted rebuild is repeated.
+
+        """
+        for level in range(self._hash_min, self._hash_max + 1):
+            for h, data_id in self._session.execute\
+                ('SELECT hash, data_id FROM hash%d' % level):
+                if len(data_id) != self._datahash_length:
+                    continue
+
+                self._session.execute\
+                    ("""
+                    INSERT INTO hash_summary
+                    (hash, level, leaf)
+                    VALUES (%s, %s, %s)""",
+                     [h[:self._hash_min], level, h])
+
+        self._mark_complete('summary')
+        if self._cache is not None:
+            self._cache.clear()
+
+
     def _insert_queries(self):
         res = {}
         res['insert_data'] = """
@@ -108,6 +321,11 @@ class Cassandra_Spatial_Index(Cassandra_Base):
         (data_id, data)
         VALUES (%s, %s)
         IF NOT EXISTS"""
+        res['insert_data_packed'] = """
+        INSERT INTO data
+        (data_id, packed)
+        VALUES (%s, %s)
+        IF NOT EXISTS"""
 
         for i in range(self._hash_min, self._hash_max + 1):
             res['insert_hash%d' % i] = \
@@ -117,28 +335,97 @@ class Cassandra_Spatial_Index(Cassandra_Base):
                 VALUES (%s, %s)
                 IF NOT EXISTS"""
 
+        res['insert_hash_summary'] = \
+            self._prepare\
+            ("""
+            INSERT INTO hash_summary
+            (hash, level, leaf)
+            VALUES (?, ?, ?)""")
+        res['insert_data_log'] = \
+            self._prepare\
+            ("""
+            INSERT INTO data_log
+            (bucket, shard, time, data_id, deleted)
+            VALUES (?, ?, ?, ?, ?)
+            USING TTL ?""")
+
+        return res
+
+
+    def _update_queries(self):
+        res = {}
+        res['update_hash_stats'] = \
+            self._prepare\
+            ("""
+            UPDATE hash_stats
+            SET count = count + ?
+            WHERE hash=?""")
+
         return res
 
 
     def _select_queries(self):
         res = {}
-        res['select_data'] = \
-            self._session.prepare\
+        res['select_data_one'] = \
+            self._prepare\
             ("""
-            SELECT data
+            SELECT data_id, data, packed
             FROM data
-            WHERE data_id in ?""")
+            WHERE data_id=?""")
+        res['select_data_range'] = \
+            self._prepare\
+            ("""
+            SELECT data_id, data, packed
+            FROM data
+            WHERE token(data_id) > ? and token(data_id) <= ?""")
+        res['select_data_log'] = \
+            self._prepare\
+            ("""
+            SELECT time, data_id, deleted
+            FROM data_log
+            WHERE bucket=? and shard=? and time>=?""")
 
         for i in range(self._hash_min, self._hash_max + 1):
             res['select_hash%d' % i] = \
-                self._session.prepare\
+                self._prepare\
                 ("""
-                SELECT data_id
+                SELECT hash, data_id
                 FROM hash%d
                 WHERE hash in ?""" % i)
 
+        for i in range(self._hash_min, self._hash_max + 1):
+            res['select_hash_any%d' % i] = \
+                self._prepare\
+                ("""
+                SELECT data_id
+                FROM hash%d
+                WHERE hash=?
+                LIMIT 1""" % i)
+
+        for i in range(self._hash_min, self._hash_max + 1):
+            res['select_hash_data%d' % i] = \
+                self._prepare\
+                ("""
+                SELECT hash
+                FROM hash%d
+                WHERE hash in ? and data_id=?""" % i)
+
+        res['select_hash_stats'] = \
+            self._prepare\
+            ("""
+            SELECT hash, count
+            FROM hash_stats
+            WHERE hash in ?""")
+
+        res['select_hash_summary'] = \
+            self._prepare\
+            ("""
+            SELECT hash, level, leaf
+            FROM hash_summary
+            WHERE hash in ?""")
+
         res['select_anydata'] = \
-            self._session.prepare\
+            self._prepare\
             ("""
             SELECT data_id
             FROM data
@@ -147,18 +434,145 @@ class Cassandra_Spatial_Index(Cassandra_Base):
         return res
 
 
-    def _load(self, data_id):
-        data = self._session.execute\
-            (self._queries['select_data'],
-             [[data_id]]).one()[0]
+    def _delete_queries(self):
+        res = {}
+        res['delete_data'] = \
+            self._prepare\
+            ("""
+            DELETE FROM data
+            WHERE data_id=?""")
+
+        for i in range(self._hash_min, self._hash_max + 1):
+            res['delete_hash%d' % i] = \
+                self._prepare\
+                ("""
+                DELETE FROM hash%d
+                WHERE hash=? and data_id=?""" % i)
+
+        res['delete_hash_summary'] = \
+            self._prepare\
+            ("""
+            DELETE FROM hash_summary
+            WHERE hash=? and level=? and leaf=?""")
+
+        return res
+
+
+    def _decode(self, row):
+        _, data, packed = row
+        if packed is not None:
+            return unpack_data(packed)
+
         return json.loads(data)
 
 
-    def _load_many(self, data_ids):
-        data = self._session.execute\
-            (self._queries['select_data'],
-             [data_ids])
-        return [json.loads(x[0]) for x in data]
+    def _iter_requests(self, name, params):
+        """Run requests of a query concurrently
+
+        At most load_concurrency requests are in flight. Failed
+        requests are retried with an exponential backoff. Results of
+        several pages are fetched page by page, with the same
+        retries, by requests with the paging state.
+
+        :name: name of the query
+
+        :params: iterable of query parameters
+
+        :return: generator of rows, mostly in the order of params
+        """
+        params = iter(params)
+        pending = collections.deque()
+
+        def request(x, state):
+            kwargs = {} if state is None else {'paging_state': state}
+            return self._session.execute_async\
+                (self._queries[name], x, **kwargs)
+
+        def submit(x, attempt = 0, state = None):
+            pending.append((x, attempt, state, request(x, state)))
+
+        for x in itertools.islice(params, self._load_concurrency):
+            submit(x)
+
+        while pending:
+            x, attempt, state, future = pending.popleft()
+            try:
+                rows = future.result()
+            except _RETRY_ERRORS:
+                if attempt >= self._load_retries:
+                    raise
+                metrics.inc('spatial_load_retries')
+                time.sleep(self._load_backoff * 2**attempt)
+                submit(x, attempt + 1, state)
+                continue
+
+            # the next page is requested before rows are consumed,
+            # iterating rows would fetch it without retries
+            if rows.paging_state is not None:
+                pending.appendleft((x, 0, rows.paging_state,
+                                    request(x, rows.paging_state)))
+            else:
+                for y in itertools.islice(params, 1):
+                    submit(y)
+            yield from rows.current_rows
+
+
+    def _iter_rows(self, data_ids):
+        """Load rows of data concurrently
+
+        Every data_id is requested separately, so that requests go
+        to replicas of the partition (see _iter_requests).
+
+        :data_ids: iterable of data_ids
+
+        :return: generator of rows, mostly in the order of data_ids
+        """
+        return self._iter_requests('select_data_one',
+                                   ([x] for x in data_ids))
+
+
+    def _iter_items(self, data_ids, report = None, times = None):
+        """Load data concurrently
+
+        :report: optional explain report of intersect
+
+        :times: optional dictionary, seconds spent waiting for rows
+        and decoding them are added to 'load' and 'decode'
+
+        :return: generator of (data_id, data), see _iter_rows
+        """
+        return self._decode_rows(self._iter_rows(data_ids),
+                                 report, times)
+
+
+    def _decode_rows(self, rows, report = None, times = None):
+        count = 0
+        while True:
+            if times is not None:
+                start = time.perf_counter()
+            row = next(rows, None)
+            if times is not None:
+                times['load'] += time.perf_counter() - start
+            if row is None:
+                break
+
+            if times is not None:
+                start = time.perf_counter()
+            data = self._decode(row)
+            count += 1
+            if times is not None:
+                times['decode'] += time.perf_counter() - start
+            if report is not None:
+                report['rows'] += 1
+                report['bytes'] += len(row[1] or '') + len(row[2] or b'')
+
+            yield row[0], data
+
+        metrics.inc('spatial_rows_loaded', count)
+
+
+    def _load_items(self, data_ids, report = None):
+        return list(self._iter_items(data_ids, report))
 
 
     def _polygon2bbox(self, polygon, lon_first):
@@ -180,25 +594,268 @@ class Cassandra_Spatial_Index(Cassandra_Base):
         return max(glat / blat, glon / blon) > self._delta
 
 
+    def _crowded(self, hashes):
+        if self._max_fanout is None:
+            return False
+
+        counts = self._session.execute\
+            (self._queries['select_hash_stats'],
+             [list(hashes)])
+        return any(x[1] >= self._max_fanout for x in counts)
+
+
+    def _count(self, hashes, increment):
+        if self._max_fanout is None:
+            return
+
+        for h in hashes:
+            self._session.execute\
+                (self._queries['update_hash_stats'],
+                 [increment, h])
+
+
+    def cell_population(self, hashes):
+        """Number of data entries stored in geohash cells
+
+        Populations are counted only if max_fanout is set.
+
+        :hashes: list of geohash cells
+
+        :return: dictionary cell -> number of entries
+        """
+        res = {h: 0 for h in hashes}
+        res.update(self._session.execute\
+                   (self._queries['select_hash_stats'],
+                    [list(hashes)]))
+        return res
+
+
     def _insert_hash(self, bbox):
         cur_hash = self._hash_min
         hashes = bbox2hash(bbox, cur_hash)
 
-        while self._hashbbox_compare(cur_hash, bbox) \
-              and cur_hash < self._hash_max:
-            hashes = bbox2hash(bbox, cur_hash + 1)
+        while cur_hash < self._hash_max:
+            deeper = bbox2hash(bbox, cur_hash + 1)
+
+            # crowded cells push data deeper only as long as the
+            # data does not spread over too many cells
+            if not self._hashbbox_compare(cur_hash, bbox) \
+               and not (len(deeper) <= _MAX_CROWDED_CELLS \
+                        and self._crowded(hashes)):
+                break
+
+            hashes = deeper
 
             for d in hashes:
                 self._session.execute\
                     (self._queries['insert_hash%d' % cur_hash],
                      [d[:-1], d])
+                self._invalidate(cur_hash, d[:-1])
             cur_hash += 1
 
         return cur_hash, hashes
 
 
+    def _leaf_covers(self, bbox):
+        """Possible leaf cells of data with a bounding box
+
+        :return: list of (level, cells)
+        """
+        cur_hash = self._hash_min
+        while self._hashbbox_compare(cur_hash, bbox) \
+              and cur_hash < self._hash_max:
+            cur_hash += 1
+        res = [(cur_hash, bbox2hash(bbox, cur_hash))]
+
+        # crowded cells might have pushed data deeper, as long as it
+        # spreads over a few cells only (see _insert_hash)
+        if self._max_fanout is None:
+            return res
+
+        for level in range(cur_hash + 1, self._hash_max + 1):
+            cells = bbox2hash(bbox, level)
+            if len(cells) > _MAX_CROWDED_CELLS:
+                break
+            res += [(level, cells)]
+
+        return res
+
+
+    def _leaf_hashes(self, bbox, data_id):
+        """Find leaf cells that contain data_id
+
+        :return: list of (level, cells)
+        """
+        res = []
+        for level, cover in self._leaf_covers(bbox):
+            cells = [x[0] for x in self._session.execute\
+                     (self._queries['select_hash_data%d' % level],
+                      [cover, data_id])]
+            if len(cells):
+                res += [(level, cells)]
+
+        return res
+
+
+    def _prune(self, level, cells):
+        """Remove links to geohash cells that became empty
+
+        :level: length of the cells
+
+        :cells: cells that might have become empty
+
+        """
+        while level > self._hash_min and len(cells):
+            parents = set()
+            for cell in cells:
+                if self._session.execute\
+                   (self._queries['select_hash_any%d' % level],
+                    [cell]).one() is not None:
+                    continue
+
+                self._session.execute\
+                    (self._queries['delete_hash%d' % (level - 1)],
+                     [cell[:-1], cell])
+                self._invalidate(level - 1, cell[:-1])
+                parents.add(cell[:-1])
+
+            cells = parents
+            level -= 1
+
+
+    def _occupied(self, level, cells):
+        # cells holding data_ids
+        return set(h for h, x in self._session.execute\
+                   (self._queries['select_hash%d' % level],
+                    [list(cells)]) \
+                   if len(x) == self._datahash_length)
+
+
+    def _prune_summary(self, level, cells):
+        """Remove cells without data from the summary
+
+        An insert writes hash rows before the summary. A concurrent
+        insert to a cell might thus write its summary row after the
+        check for data and before the row is deleted here. Cells are
+        therefore checked once more after the delete, and summary rows
+        of cells with data are written again.
+
+        :level: length of the cells
+
+        :cells: leaf cells that might have lost their last data
+
+        """
+        occupied = self._occupied(level, cells)
+        emptied = [x for x in cells if x not in occupied]
+
+        for cell in emptied:
+            self._session.execute\
+                (self._queries['delete_hash_summary'],
+                 [cell[:self._hash_min], level, cell])
+            self._invalidate('summary', cell[:self._hash_min])
+
+        if not emptied:
+            return
+
+        for cell in self._occupied(level, emptied):
+            self._session.execute\
+                (self._queries['insert_hash_summary'],
+                 [cell[:self._hash_min], level, cell])
+            self._invalidate('summary', cell[:self._hash_min])
+
+
+    def _find_data_id(self, data, bbox):
+        """Find data as it is read back from the index
+
+        Data read from packed rows differ from inserted data, e.g. in
+        types of coordinates, and so does the hash of data. Data in
+        the leaf cells of the bounding box are compared with data
+        packed in the same way.
+
+        :return: data_id or None
+        """
+        dtype = 'float64' if 'json' == self._encoding \
+            else self._encoding
+        packed = pack_data(data, dtype = dtype)
+
+        data_ids = set()
+        for level, cover in self._leaf_covers(bbox):
+            data_ids.update\
+                (x for _, x in self._session.execute\
+                 (self._queries['select_hash%d' % level],
+                  [cover]) \
+                 if len(x) == self._datahash_length)
+
+        for data_id, stored in self._iter_items(data_ids):
+            if packed == pack_data(stored, dtype = dtype):
+                return data_id
+
+        return None
+
+
+    def delete(self, data, lon_first = True):
+        """Delete data from the index
+
+        Links to geohash cells that become empty are removed as
+        well. Note, a concurrent insert to a pruned cell from another
+        process might become unreachable.
+
+        :data: data as it was inserted, or as it is returned by
+        queries
+
+        :return: False if data is not in the index
+        """
+        data_id = hash_string(json.dumps(data, default = json_default))
+        bbox = self._polygon2bbox(data['polygon'],
+                                  lon_first)
+
+        if self._session.execute\
+           (self._queries['select_anydata'],
+            [data_id]).one() is None:
+            data_id = self._find_data_id(data, bbox)
+        if data_id is None:
+            return False
+
+        leafs = self._leaf_hashes(bbox, data_id)
+
+        for hash_len, hashes in leafs:
+            for h in hashes:
+                self._session.execute\
+                    (self._queries['delete_hash%d' % hash_len],
+                     [h, data_id])
+                self._invalidate(hash_len, h)
+            self._count(hashes, -1)
+
+        futures = [self._session.execute_async\
+                   (self._queries['delete_data'],
+                    [data_id])]
+        futures += self._log_async(data_id, True)
+        for x in futures:
+            x.result()
+
+        for hash_len, hashes in leafs:
+            self._prune_summary(hash_len, hashes)
+            self._prune(hash_len, hashes)
+        return True
+
+
+    def update(self, old, new, lon_first = True):
+        """Replace data in the index
+
+        :old: data to remove, see delete
+
+        :new: data to insert
+
+        :return: False if old is not in the index
+        """
+        res = self.delete(old, lon_first = lon_first)
+        self.insert(new, lon_first = lon_first)
+        return res
+
+
     def insert(self, data, lon_first = True):
-        data_s = json.dumps(data)
+        # data_id does not depend on the encoding
+        data_s = json.dumps(data, default = json_default)
         data_id = hash_string(data_s)
 
         if self._session.execute\
@@ -209,52 +866,422 @@ class Cassandra_Spatial_Index(Cassandra_Base):
         bbox = self._polygon2bbox(data['polygon'],
                                   lon_first)
         hash_len, hashes = self._insert_hash(bbox)
+        metrics.inc('spatial_inserts')
+        metrics.inc('spatial_hash_rows', len(hashes))
 
         for h in hashes:
             self._session.execute\
                 (self._queries['insert_hash%d' % hash_len],
                  [h, data_id])
+            self._invalidate(hash_len, h)
+            self._session.execute\
+                (self._queries['insert_hash_summary'],
+                 [h[:self._hash_min], hash_len, h])
+            self._invalidate('summary', h[:self._hash_min])
+        self._count(hashes, 1)
+
+        if 'json' == self._encoding:
+            futures = [self._session.execute_async\
+                       (self._queries['insert_data'],
+                        [data_id, data_s])]
+        else:
+            futures = [self._session.execute_async\
+                       (self._queries['insert_data_packed'],
+                        [data_id, pack_data(data, dtype = self._encoding)])]
+        futures += self._log_async(data_id, False)
+        for x in futures:
+            x.result()
+
+
+    def _log_async(self, data_id, deleted):
+        """Record a change of data in the data_log table
+
+        :return: list of futures, empty if logging is off
+        """
+        if not self._log:
+            return []
 
-        self._session.execute\
-            (self._queries['insert_data'],
-             [data_id, data_s])
+        # changes of an hour are spread over log_shards partitions
+        now = time.time()
+        return [self._session.execute_async\
+                (self._queries['insert_data_log'],
+                 [int(now // _LOG_BUCKET),
+                  int(data_id[:8], 16) % self._log_shards,
+                  now, data_id, deleted, self._log_ttl or 0])]
+
+
+    def _read_log(self, since):
+        """Changes of data since a time
+
+        :return: dictionary data_id -> True if the last change is a
+        delete
+        """
+        buckets = range(int(since // _LOG_BUCKET),
+                        int(time.time() // _LOG_BUCKET) + 1)
+        changes = sorted(self._iter_requests\
+                         ('select_data_log',
+                          ([x, shard, since] for x in buckets \
+                           for shard in range(self._log_shards))))
+        return {data_id: bool(deleted) \
+                for _, data_id, deleted in changes}
+
+
+    def _token_ranges(self, splits):
+        # (start, end] ranges covering the murmur3 token ring
+        step = 2**64 // splits
+        bounds = [-2**63 + i * step for i in range(splits)] + [2**63 - 1]
+        return [[lo, hi] for lo, hi in zip(bounds[:-1], bounds[1:])]
+
+
+    def _save_snapshot(self, path, items, timestamp):
+        """Write a new version of a snapshot
+
+        Every version is a directory next to 'path', which is a
+        symbolic link to the current version. The link is replaced
+        atomically when the version is complete.
+
+        A snapshot holds one data per file, as Polygon_File_Index:
+        the data with the greatest data_id. Other data of the same
+        files are kept in shadowed.json, so that refresh gives the
+        same snapshot as export.
+
+        :items: iterable of (data_id, data)
+
+        :return: directory of the replaced version or None
+        """
+        chosen, shadowed = {}, []
+        for data_id, data in items:
+            other = chosen.get(data['file'])
+            if other is not None and other[0] > data_id:
+                shadowed += [(data_id, data)]
+                continue
+            if other is not None:
+                shadowed += [other]
+            chosen[data['file']] = (data_id, data)
+
+        path = path.rstrip(os.sep)
+        version = '%s.%s' % (path, uuid.uuid4().hex)
+        Polygon_File_Index((x for _, x in chosen.values()),
+                           compact = True).save_binary(version)
+        np.save(os.path.join(version, 'data_ids.npy'),
+                np.array([x for x, _ in chosen.values()], dtype = str))
+        with open(os.path.join(version, 'shadowed.json'), 'w') as f:
+            json.dump(shadowed, f, default = json_default)
+        with open(os.path.join(version, 'snapshot.json'), 'w') as f:
+            json.dump({'time': timestamp}, f)
+
+        previous = None
+        if os.path.islink(path):
+            previous = os.path.realpath(path)
+        elif os.path.exists(path):
+            # a directory from an older version of export, moved away
+            # as a link cannot replace it
+            previous = '%s.%s' % (path, uuid.uuid4().hex)
+            os.rename(path, previous)
+
+        link = version + '.link'
+        os.symlink(os.path.basename(version), link)
+        os.replace(link, path)
+        return previous
+
+
+    def _open_snapshot(self, path, previous):
+        if previous is not None:
+            shutil.rmtree(previous, ignore_errors = True)
+
+        res = Polygon_File_Index()
+        res.load_binary(os.path.realpath(path))
+        return res
+
+
+    def export(self, path, splits = 256):
+        """Save all data to a local snapshot
+
+        The data table is read with concurrent token range scans. The
+        snapshot is a Polygon_File_Index saved with save_binary,
+        together with data_ids of its records and the time of the
+        export (see refresh).
+
+        :path: path of the snapshot, replaced if it exists. It is a
+        symbolic link to the current version directory
+
+        :splits: number of token ranges
+
+        :return: Polygon_File_Index loaded from the snapshot
+        """
+        timestamp = time.time()
+        items = self._decode_rows\
+            (self._iter_requests('select_data_range',
+                                 self._token_ranges(splits)))
+        return self._open_snapshot\
+            (path, self._save_snapshot(path, items, timestamp))
+
+
+    def refresh(self, path):
+        """Update a snapshot with changes since it was made
+
+        Only data inserted or deleted since the snapshot is read, as
+        recorded in the data_log table. Snapshots older than log_ttl
+        have to be exported again. Requires log=True for all writers
+        of the index.
+
+        :path: directory of a snapshot made by export or refresh
 
+        :return: Polygon_File_Index loaded from the snapshot
+        """
+        if not self._log:
+            raise RuntimeError("refresh needs the data log, use log=True")
+
+        # files are read from one version, path might be replaced
+        current = os.path.realpath(path)
+        with open(os.path.join(current, 'snapshot.json'), 'r') as f:
+            since = json.load(f)['time']
+
+        timestamp = time.time()
+        if self._log_ttl is not None \
+           and timestamp - since > self._log_ttl - _LOG_SKEW:
+            raise RuntimeError("snapshot %s is older than the data log, "
+                               "use export" % path)
+
+        changes = self._read_log(since - _LOG_SKEW)
+        old = Polygon_File_Index()
+        old.load_binary(current)
+        data_ids = np.load(os.path.join(current, 'data_ids.npy'))
+        with open(os.path.join(current, 'shadowed.json'), 'r') as f:
+            shadowed = json.load(f)
+
+        kept = ((str(x), data) \
+                for x, data in itertools.chain\
+                (zip(data_ids, old.iterate()), shadowed) \
+                if x not in changes)
+        added = self._iter_items\
+            ([x for x, deleted in changes.items() if not deleted])
+        previous = self._save_snapshot\
+            (path, itertools.chain(kept, added), timestamp)
+
+        # memory-mapped files of the old version are released before
+        # it is removed
+        old = data_ids = kept = None
+        return self._open_snapshot(path, previous)
+
+
+    def _invalidate(self, level, cell):
+        if self._cache is not None:
+            self._cache.pop((level, cell))
+
+
+    def _query_cells(self, level, hashes, report = None):
+        """Query content of geohash cells
+
+        :level: length of the geohash cells
+
+        :hashes: iterable of geohash cells
+
+        :report: optional explain report of intersect
+
+        :return: dictionary cell -> list of child hashes and data_ids
+        """
+        res = {}
+        missing = []
+        for h in hashes:
+            x = None
+            if self._cache is not None:
+                x = self._cache.get((level, h))
+
+            if x is None:
+                missing += [h]
+            else:
+                res[h] = x
+
+        metrics.inc('spatial_cache_hits', len(res))
+        metrics.inc('spatial_cache_misses', len(missing))
+        if report is not None:
+            report['levels'][level] = {'cells': len(res) + len(missing),
+                                       'cached': len(res),
+                                       'partitions': len(missing)}
+        if not missing:
+            return res
+
+        fetched = {h: [] for h in missing}
+        q_res = self._session.execute\
+            (self._queries['select_hash%d' % level],
+             query.ValueSequence\
+             ([missing]))
+        for h, x in q_res:
+            fetched[h] += [x]
+
+        if self._cache is not None:
+            for h, x in fetched.items():
+                self._cache.put((level, h), x)
+
+        res.update(fetched)
+        return res
+
+
+    def _query_summary(self, hashes, report = None):
+        """Query occupied leaf cells below cells of length hash_min
+
+        :hashes: iterable of cells of length hash_min
+
+        :report: optional explain report of intersect
+
+        :return: dictionary level -> list of leaf cells
+        """
+        summaries = {}
+        missing = []
+        for h in hashes:
+            x = None
+            if self._cache is not None:
+                x = self._cache.get(('summary', h))
+
+            if x is None:
+                missing += [h]
+            else:
+                summaries[h] = x
+
+        metrics.inc('spatial_cache_hits', len(summaries))
+        metrics.inc('spatial_cache_misses', len(missing))
+        if report is not None:
+            report['summary'] = {'cells': len(summaries) + len(missing),
+                                 'cached': len(summaries),
+                                 'partitions': len(missing)}
+
+        if missing:
+            fetched = {h: [] for h in missing}
+            for h, level, leaf in self._session.execute\
+                (self._queries['select_hash_summary'],
+                 [missing]):
+                fetched[h] += [(level, leaf)]
+
+            if self._cache is not None:
+                for h, x in fetched.items():
+                    self._cache.put(('summary', h), x)
+            summaries.update(fetched)
+
+        res = collections.defaultdict(list)
+        for level, leaf in itertools.chain.from_iterable\
+            (summaries.values()):
+            res[level] += [leaf]
+
+        if report is not None:
+            report['summary']['leafs'] = sum(len(x) for x in res.values())
+        return res
+
+
+    def _query_leafs(self, hashes, polygons, lon_first, report = None):
+        """Query data_ids from leaf cells listed in the summary
+
+        Empty subtrees are skipped, only occupied leaf cells that
+        intersect the polygons are read.
+
+        :hashes: cells of length hash_min covering the polygons
+
+        :return: see _query_polygons
+        """
+        start = time.perf_counter()
+        leafs = self._query_summary\
+            (hashes_intersect(hashes, polygons, lon_first = lon_first),
+             report)
+        if report is not None:
+            report['time']['cells'] += time.perf_counter() - start
+
+        data_ids = []
+        for level in sorted(leafs):
+            start = time.perf_counter()
+            cells = hashes_intersect(leafs[level], polygons,
+                                     lon_first = lon_first)
+            if report is not None:
+                report['time']['cover'] += time.perf_counter() - start
+                start = time.perf_counter()
+            if not cells:
+                continue
+
+            found = len(data_ids)
+            for x in itertools.chain.from_iterable\
+                (self._query_cells(level, cells, report).values()):
+                if len(x) == self._datahash_length:
+                    data_ids += [x]
+
+            if report is not None:
+                report['levels'][level]['data_ids'] = \
+                    len(data_ids) - found
+                report['levels'][level]['children'] = 0
+                report['time']['cells'] += time.perf_counter() - start
 
-    def _query_bbox(self, bbox_list):
+        return data_ids
+
+
+    def _use_summary(self):
+        # a partial summary would miss data
+        if self._summary and not self._summary_complete:
+            self._summary_complete = self._is_complete('summary')
+            if not self._summary_complete:
+                logging.warning("Cassandra_Spatial_Index: the summary "
+                                "is not complete, run rebuild_summary")
+
+        return self._summary and self._summary_complete
+
+
+    def _query_polygons(self, polygons, lon_first, report = None):
         """Query data_ids from the Cassandra Spatial Index
 
-        :bbox_list: list of bounding box of the query
+        Only geohash cells intersecting the polygons are queried on
+        every level, or only occupied leaf cells if the summary is
+        used.
+
+        :polygons: geometry.MultiPolygon of the query
+
+        :lon_first: coordinate order of the polygons
+
+        :report: optional explain report of intersect
 
         :return: a list of data_ids that *might have* a non-zero
-        intersection with a desired bbox
+        intersection with the polygons
 
         """
+        start = time.perf_counter()
         cur_hash = self._hash_min
-        hashes = bboxes2hash(bbox_list, cur_hash)
+        hashes = bboxes2hash([self._polygon2bbox(pl, lon_first) \
+                              for pl in polygons.geoms],
+                             cur_hash)
+        if report is not None:
+            report['time']['cover'] += time.perf_counter() - start
+        if self._use_summary():
+            return self._query_leafs(hashes, polygons, lon_first, report)
+
+        start = time.perf_counter()
         data_ids = []
 
         while len(hashes):
-            hashes = set(hashes)\
-                .intersection(bboxes2hash(bbox_list, cur_hash))
-            q_res = self._session.execute\
-                (self._queries['select_hash%d' % cur_hash],
-                 query.ValueSequence\
-                 ([hashes]))
+            hashes = hashes_intersect(set(hashes), polygons,
+                                      lon_first = lon_first)
+            if report is not None:
+                report['time']['cover'] += time.perf_counter() - start
+                start = time.perf_counter()
+
+            q_res = self._query_cells(cur_hash, hashes, report)
 
             hashes = []
-            for x in q_res:
-                x = x[0]
+            found = len(data_ids)
+            for x in itertools.chain.from_iterable(q_res.values()):
                 if len(x) == self._datahash_length:
                     data_ids += [x]
                 else:
                     hashes += [x]
+
+            if report is not None:
+                report['levels'][cur_hash]['data_ids'] = \
+                    len(data_ids) - found
+                report['levels'][cur_hash]['children'] = len(hashes)
+                report['time']['cells'] += time.perf_counter() - start
+                start = time.perf_counter()
             cur_hash += 1
 
         return data_ids
 
 
     def intersect(self, polygons, lon_first = True,
-                  chunk_size = 2**15):
+                  chunk_size = 2**15, explain = False):
         """Produce an index that has an intersection with a given polygons
 
         :polygons: either a list of coordinate tuples, or a
@@ -263,7 +1290,38 @@ class Cassandra_Spatial_Index(Cassandra_Base):
         :chunk_size: number of data entries to query per
         iteration. One spatial index entry is about 500 bytes.
 
+        :explain: if True, return a tuple (index, report). The report
+        is a dictionary with
+
+          'levels': for every queried hash level the number of
+          'cells' covering the query, 'cached' cells, 'partitions'
+          read from the cluster, and found 'data_ids' and 'children'
+          cells
+
+          'summary': if the summary is used, the number of 'cells',
+          'cached' cells and 'partitions' read of the summary, and
+          the number of occupied 'leafs' below the cells
+
+          'candidates': distinct data_ids, 'duplicates': data_ids
+          found in more than one cell, 'matches': data intersecting
+          the query
+
+          'rows' and 'bytes' of loaded data
+
+          'time': wall time in seconds of the phases: 'cover' (hash
+          covering of the query), 'cells' (hash table queries),
+          'load', 'decode', 'filter' (shapely intersection tests),
+          'index' (building of the result) and 'total'
+
         """
+        report = None
+        if explain:
+            report = {'levels': {}, 'rows': 0, 'bytes': 0,
+                      'time': dict.fromkeys(['cover', 'cells', 'load',
+                                             'decode', 'filter',
+                                             'index'], 0)}
+        total = time.perf_counter()
+
         if not isinstance(polygons, geometry.multipolygon.MultiPolygon):
             if isinstance(polygons, geometry.polygon.Polygon):
                 polygons = geometry.multipolygon.MultiPolygon([polygons])
@@ -274,32 +1332,124 @@ class Cassandra_Spatial_Index(Cassandra_Base):
                 polygons = geometry.multipolygon.MultiPolygon\
                     ([geometry.polygon.Polygon(x) for x in polygons])
 
-        logging.debug("intersect: BEGIN _polygon2bbox")
-        bboxes = [self._polygon2bbox(pl, lon_first) for pl in polygons]
-        logging.debug("intersect: END _polygon2bbox")
-        logging.debug("intersect: BEGIN _query_bbox")
-        data_ids = list(set(self._query_bbox(bboxes)))
-        logging.debug("intersect: END _query_bbox")
+        with metrics.timer('spatial_intersect_query_seconds'):
+            data_ids = self._query_polygons(polygons, lon_first, report)
+            found = len(data_ids)
+            data_ids = list(set(data_ids))
+        metrics.inc('spatial_candidates', len(data_ids))
 
-        index = Polygon_File_Index()
-        for data_chunk in _chunker(data_ids, size = chunk_size):
-            logging.debug("intersect: BEGIN _load_many")
-            datas = self._load_many(data_chunk)
-            logging.debug("intersect: END _load_many")
+        # rows are timed only if asked for
+        timed = report is not None or metrics.get() is not None
 
-            for i, data in enumerate(datas):
-                logging.debug("intersect: enumerate %d" % i)
-
-                logging.debug("intersect: BEGIN polygon.intesects")
+        res = []
+        for data_chunk in _chunker(data_ids, size = chunk_size):
+            times = None
+            if timed:
+                times = dict.fromkeys(['load', 'decode', 'filter'], 0)
+
+            # data is filtered as it arrives
+            for _, data in self._iter_items(data_chunk, report, times):
+                if timed:
+                    start = time.perf_counter()
                 # ignore data that has no intersection
-                if not polygons.intersects\
+                if polygons.intersects\
                    (geometry.polygon.Polygon(data['polygon'])):
-                    logging.debug("intersect: END polygon.intesects")
-                    continue
-                logging.debug("intersect: END polygon.intesects")
+                    res += [data]
+                if timed:
+                    times['filter'] += time.perf_counter() - start
+
+            if not timed:
+                continue
+            metrics.observe('spatial_intersect_load_seconds',
+                            times['load'] + times['decode'])
+            metrics.observe('spatial_intersect_filter_seconds',
+                            times['filter'])
+            if report is not None:
+                for k, v in times.items():
+                    report['time'][k] += v
+        metrics.inc('spatial_filtered', len(data_ids) - len(res))
+
+        start = time.perf_counter()
+        with metrics.timer('spatial_intersect_index_seconds'):
+            index = Polygon_File_Index(res)
+
+        if report is None:
+            return index
+
+        report['time']['index'] = time.perf_counter() - start
+        report['time']['total'] = time.perf_counter() - total
+        report.update({'candidates': len(data_ids),
+                       'duplicates': found - len(data_ids),
+                       'matches': len(res)})
+        return index, report
+
+
+    def contains_points(self, points, lon_first = True,
+                        chunk_size = 2**15):
+        """Find data that contain given points
+
+        Exactly one geohash cell per level is queried for every
+        point.
+
+        :points: list of (lat, lon) tuples or an array of shape (n,2)
+
+        :lon_first: coordinate order of the stored polygons
 
-                logging.debug("intersect: BEGIN insert")
-                index.insert(data)
-                logging.debug("intersect: END insert")
+        :chunk_size: number of data entries to query per iteration
 
-        return index
+        :return: list of lists of data, one list per point
+        """
+        points = np.asarray(points, dtype = float).reshape(-1, 2)
+        cells = [geohash.encode(lat, lon, precision = self._hash_max) \
+                 for lat, lon in points]
+
+        candidates = [set() for _ in cells]
+        for level in range(self._hash_min, self._hash_max + 1):
+            q_res = self._query_cells\
+                (level, set(x[:level] for x in cells))
+            for i, cell in enumerate(cells):
+                candidates[i].update\
+                    (x for x in q_res[cell[:level]] \
+                     if len(x) == self._datahash_length)
+
+        data_ids = list(set().union(*candidates))
+        datas, positions = [], {}
+        for data_chunk in _chunker(data_ids, size = chunk_size):
+            for data_id, data in self._load_items(data_chunk):
+                positions[data_id] = len(datas)
+                datas += [data]
+
+        # (point, data) pairs to test
+        pairs = np.array([(i, positions[x]) \
+                          for i, cand in enumerate(candidates) \
+                          for x in cand if x in positions],
+                         dtype = int).reshape(-1, 2)
+        geoms = np.array([geometry.Polygon(x['polygon']) \
+                          for x in datas], dtype = object)
+        shapely.prepare(geoms)
+
+        x, y = points[:,1], points[:,0]
+        if not lon_first:
+            x, y = y, x
+
+        mask = shapely.intersects_xy\
+            (geoms[pairs[:,1]], x[pairs[:,0]], y[pairs[:,0]])
+
+        res = [[] for _ in cells]
+        for i, j in pairs[mask]:
+            res[i] += [datas[j]]
+
+        return res
+
+
+    def contains_point(self, lat, lon, lon_first = True):
+        """Find data that contain a given point
+
+        :lat, lon: coordinates of the point
+
+        :lon_first: coordinate order of the stored polygons
+
+        :return: list of data
+        """
+        return self.contains_points([(lat, lon)],
+                                    lon_first = lon_first)[0]
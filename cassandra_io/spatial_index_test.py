@@ -1,8 +1,21 @@
+import os
+import shutil
+import tempfile
 
 from cassandra_io.polygon_index import \
     Polygon_File_Index
 from cassandra_io.spatial_index import \
     Cassandra_Spatial_Index
+from cassandra import OperationTimedOut
+
+from cassandra_io import metrics
+from cassandra_io.utils import bbox2hash
+
+from shapely import geometry
+
+
+# tests run on a live cluster with CASSANDRA_IO_TEST_BACKEND=cassandra
+BACKEND = os.environ.get('CASSANDRA_IO_TEST_BACKEND', 'sqlite')
 
 
 def dummy_index_data():
@@ -29,10 +42,10 @@ def dummy_index_data():
     return x
 
 
-def test_spatial_index(ips = ['10.2.2.2']):
+def test_spatial_index(ips = ['10.2.2.2'], backend = BACKEND):
     try:
         cfs = Cassandra_Spatial_Index\
-            (cluster_ips = ips,
+            (cluster_ips = ips, backend = backend,
              keyspace = 'test_spatial_index')
         idx = dummy_index_data()
 
@@ -49,5 +62,556 @@ def test_spatial_index(ips = ['10.2.2.2']):
             pass
 
 
+def test_spatial_index_packed(ips = ['10.2.2.2'], backend = BACKEND):
+    try:
+        cfs = Cassandra_Spatial_Index\
+            (cluster_ips = ips, backend = backend,
+             keyspace = 'test_spatial_index_packed',
+             encoding = 'float64')
+        idx = dummy_index_data()
+
+        for x in idx.iterate():
+            cfs.insert(x)
+
+        idx2 = cfs.intersect([(0,0),(0,1),(1,1),(1,0)])
+
+        assert idx.size() == idx2.size()
+        assert set(idx.files()) == set(idx2.files())
+
+        # data read back have float coordinates, but can be deleted
+        data = {'file': 'int', 'polygon': [(0,0),(0,1),(1,1),(1,0)]}
+        cfs.insert(data)
+        back = [x for x in cfs.intersect(data['polygon']).iterate() \
+                if x['file'] == 'int']
+        assert 1 == len(back)
+        moved = dict(data, polygon = [(5,5),(5,6),(6,6),(6,5)])
+        assert cfs.update(back[0], moved)
+        assert ['int'] == list(cfs.intersect(moved['polygon']).files())
+        assert 'int' not in set(cfs.intersect(data['polygon']).files())
+        assert not cfs.delete(data)
+    finally:
+        try:
+            cfs.drop_keyspace()
+        except:
+            pass
+
+
+def test_spatial_index_cache(ips = ['10.2.2.2'], backend = BACKEND):
+    try:
+        cfs = Cassandra_Spatial_Index\
+            (cluster_ips = ips, backend = backend,
+             keyspace = 'test_spatial_index_cache',
+             cache_size = 1024)
+        idx = dummy_index_data()
+        data = list(idx.iterate())
+
+        for x in data[:-1]:
+            cfs.insert(x)
+
+        query = [(0,0),(0,1),(1,1),(1,0)]
+        assert idx.size() - 1 == cfs.intersect(query).size()
+        assert idx.size() - 1 == cfs.intersect(query).size()
+
+        # inserts invalidate cached cells
+        cfs.insert(data[-1])
+        assert idx.size() == cfs.intersect(query).size()
+    finally:
+        try:
+            cfs.drop_keyspace()
+        except:
+            pass
+
+
+def test_spatial_index_delete(ips = ['10.2.2.2'], backend = BACKEND):
+    try:
+        cfs = Cassandra_Spatial_Index\
+            (cluster_ips = ips, backend = backend,
+             keyspace = 'test_spatial_index_delete')
+        idx = dummy_index_data()
+
+        for x in idx.iterate():
+            cfs.insert(x)
+
+        query = [(0,0),(0,1),(1,1),(1,0)]
+        data = list(idx.iterate())
+        assert cfs.delete(data[0])
+        assert not cfs.delete(data[0])
+        assert idx.size() - 1 == cfs.intersect(query).size()
+
+        moved = dict(data[1])
+        moved['polygon'] = [(10,10),(10,11),(11,11),(11,10)]
+        assert cfs.update(data[1], moved)
+        assert idx.size() - 2 == cfs.intersect(query).size()
+        assert 1 == cfs.intersect(moved['polygon']).size()
+
+        for x in data[2:]:
+            cfs.delete(x)
+        cfs.delete(moved)
+        assert 0 == cfs.intersect(query).size()
+        # links to empty cells are pruned
+        for i in range(cfs._hash_min, cfs._hash_max + 1):
+            assert 0 == len(list(cfs._session.execute\
+                                 ('SELECT hash FROM hash%d' % i)))
+        assert 0 == len(list(cfs._session.execute\
+                             ('SELECT hash FROM hash_summary')))
+    finally:
+        try:
+            cfs.drop_keyspace()
+        except:
+            pass
+
+
+def test_spatial_index_contains_point(ips = ['10.2.2.2'], backend = BACKEND):
+    try:
+        cfs = Cassandra_Spatial_Index\
+            (cluster_ips = ips, backend = backend,
+             keyspace = 'test_spatial_index_contains_point')
+        idx = dummy_index_data()
+
+        for x in idx.iterate():
+            cfs.insert(x)
+
+        assert set(['big','one','two','three','four']) == \
+            set(x['file'] for x in cfs.contains_point(0.5, 0.5))
+        assert [5, 1, 0] == \
+            [len(x) for x in cfs.contains_points\
+             ([(0.5,0.5),(1.5,1.5),(5,5)])]
+        assert [[]] == cfs.contains_points([(50,50)])
+    finally:
+        try:
+            cfs.drop_keyspace()
+        except:
+            pass
+
+
+def test_spatial_index_fanout(ips = ['10.2.2.2'], backend = BACKEND):
+    try:
+        cfs = Cassandra_Spatial_Index\
+            (cluster_ips = ips, backend = backend,
+             keyspace = 'test_spatial_index_fanout',
+             max_fanout = 2)
+        data = [{'file': str(i),
+                 'polygon': [(1+i/100,1),(1+i/100,2),
+                             (2+i/100,2),(2+i/100,1)]} \
+                for i in range(12)]
+
+        for x in data:
+            cfs.insert(x)
+
+        # crowded cells push new data deeper
+        population = cfs.cell_population(bbox2hash([1,1,2.2,2], 3))
+        assert 0 < max(population.values()) <= 2
+        assert 12 == cfs.intersect([(0,0),(0,6),(6,6),(6,0)]).size()
+
+        for x in data:
+            assert cfs.delete(x)
+        assert 0 == cfs.intersect([(0,0),(0,6),(6,6),(6,0)]).size()
+        assert 0 == max(cfs.cell_population\
+                        (bbox2hash([1,1,2.2,2], 4)).values())
+
+        # deletes do not look for data in levels it cannot reach
+        deep = Cassandra_Spatial_Index\
+            (cluster_ips = ips, backend = backend,
+             keyspace = 'test_spatial_index_fanout_deep',
+             depth = 6, max_fanout = 2)
+        covers = deep._leaf_covers([1,1,2,2])
+        assert sum(len(x) for _, x in covers) < 1000
+        for x in data[:3]:
+            deep.insert(x)
+        for x in data[:3]:
+            assert deep.delete(x)
+        assert 0 == deep.intersect([(0,0),(0,6),(6,6),(6,0)]).size()
+    finally:
+        try:
+            cfs.drop_keyspace()
+        except:
+            pass
+        try:
+            deep.drop_keyspace()
+        except:
+            pass
+
+
+def test_spatial_index_diagonal(ips = ['10.2.2.2'], backend = BACKEND):
+    try:
+        cfs = Cassandra_Spatial_Index\
+            (cluster_ips = ips, backend = backend,
+             keyspace = 'test_spatial_index_diagonal')
+        for i in range(10):
+            for j in range(10):
+                cfs.insert({'file': '%d_%d' % (i,j),
+                            'polygon': [(i+0.4,j+0.4),(i+0.4,j+0.6),
+                                        (i+0.6,j+0.6),(i+0.6,j+0.4)]})
+
+        strip = geometry.Polygon([(0,0),(0.1,0),(10,9.9),
+                                  (10,10),(9.9,10),(0,0.1)])
+        res = cfs.intersect(strip)
+        assert set('%d_%d' % (i,i) for i in range(10)) == \
+            set(res.files())
+
+        # cells away from the diagonal are not queried
+        candidates = cfs._query_polygons\
+            (geometry.MultiPolygon([strip]), lon_first = True)
+        assert len(set(candidates)) < 20
+    finally:
+        try:
+            cfs.drop_keyspace()
+        except:
+            pass
+
+
+def test_spatial_index_metrics(ips = ['10.2.2.2'], backend = BACKEND):
+    try:
+        cfs = Cassandra_Spatial_Index\
+            (cluster_ips = ips, backend = backend,
+             keyspace = 'test_spatial_index_metrics')
+        idx = dummy_index_data()
+
+        m = metrics.enable()
+        for x in idx.iterate():
+            cfs.insert(x)
+        assert idx.size() == m.counter('spatial_inserts')
+
+        query = [(0,0),(0,1),(1,1),(1,0)]
+        m.reset()
+        res = cfs.intersect(query)
+        assert res.size() == m.counter('spatial_candidates') \
+            - m.counter('spatial_filtered')
+        assert m.counter('requests') > 0
+        assert m.counter('requests') \
+            == m.histogram('request_seconds').count
+        assert 1 == m.histogram('spatial_intersect_query_seconds').count
+        assert 1 == m.histogram('spatial_intersect_load_seconds').count
+        assert 1 == m.histogram('spatial_intersect_filter_seconds').count
+    finally:
+        metrics.disable()
+        try:
+            cfs.drop_keyspace()
+        except:
+            pass
+
+
+def test_spatial_index_explain(ips = ['10.2.2.2'], backend = BACKEND):
+    try:
+        cfs = Cassandra_Spatial_Index\
+            (cluster_ips = ips, backend = backend,
+             keyspace = 'test_spatial_index_explain',
+             cache_size = 1024, summary = False)
+        idx = dummy_index_data()
+        for x in idx.iterate():
+            cfs.insert(x)
+
+        query = [(0,0),(0,1),(1,1),(1,0)]
+        res, report = cfs.intersect(query, explain = True)
+        assert res.size() == cfs.intersect(query).size()
+        assert res.size() == report['matches']
+        assert report['candidates'] == report['rows']
+        assert report['bytes'] > 0
+        assert report['candidates'] + report['duplicates'] \
+            == sum(x['data_ids'] for x in report['levels'].values())
+        assert cfs._hash_min in report['levels']
+        assert report['time']['total'] >= report['time']['cells']
+
+        # the second query reads cells from the cache
+        _, report = cfs.intersect(query, explain = True)
+        assert 0 == sum(x['partitions'] \
+                        for x in report['levels'].values())
+    finally:
+        try:
+            cfs.drop_keyspace()
+        except:
+            pass
+
+
+def test_spatial_index_summary(ips = ['10.2.2.2'], backend = BACKEND):
+    try:
+        cfs = Cassandra_Spatial_Index\
+            (cluster_ips = ips, backend = backend,
+             keyspace = 'test_spatial_index_summary',
+             cache_size = 1024, summary = True)
+        walk = Cassandra_Spatial_Index\
+            (cluster_ips = ips, backend = backend,
+             keyspace = 'test_spatial_index_summary',
+             summary = False)
+        idx = dummy_index_data()
+        for x in idx.iterate():
+            cfs.insert(x)
+
+        queries = [[(0,0),(0,1),(1,1),(1,0)],
+                   [(0,0),(0,0.001),(0.001,0.001),(0.001,0)],
+                   [(1.5,1.5),(1.5,3),(3,3),(3,1.5)],
+                   [(10,10),(10,11),(11,11),(11,10)]]
+        for query in queries:
+            assert set(cfs.intersect(query).files()) \
+                == set(walk.intersect(query).files())
+
+        # only occupied leaf cells are read
+        _, report = cfs.intersect(queries[1], explain = True)
+        assert report['summary']['leafs'] > 0
+        assert all(x['children'] == 0 for x in report['levels'].values())
+        _, report = cfs.intersect(queries[3], explain = True)
+        assert report['candidates'] == 0
+        assert report['levels'] == {}
+
+        # the summary can be rebuilt from the hash tables
+        leafs = set(cfs._session.execute\
+                    ('SELECT hash, level, leaf FROM hash_summary'))
+        for x in leafs:
+            cfs._session.execute\
+                (cfs._queries['delete_hash_summary'], list(x))
+        cfs.rebuild_summary()
+        assert leafs == set(cfs._session.execute\
+                            ('SELECT hash, level, leaf FROM hash_summary'))
+
+        # a partial summary, as of an interrupted rebuild, is not used
+        # and is rebuilt only on request
+        cfs._session.execute("DELETE FROM schema_state WHERE name='summary'")
+        for x in list(leafs)[1:]:
+            cfs._session.execute\
+                (cfs._queries['delete_hash_summary'], list(x))
+        Cassandra_Spatial_Index\
+            (cluster_ips = ips, backend = backend,
+             keyspace = 'test_spatial_index_summary')
+        partial = Cassandra_Spatial_Index\
+            (cluster_ips = ips, backend = backend,
+             keyspace = 'test_spatial_index_summary',
+             summary = True, read_only = True)
+        assert 1 == len(list(cfs._session.execute\
+                             ('SELECT leaf FROM hash_summary')))
+        for query in queries:
+            assert set(partial.intersect(query).files()) \
+                == set(walk.intersect(query).files())
+        _, report = partial.intersect(queries[1], explain = True)
+        assert 'summary' not in report
+
+        Cassandra_Spatial_Index\
+            (cluster_ips = ips, backend = backend,
+             keyspace = 'test_spatial_index_summary',
+             summary = True)
+        assert leafs == set(cfs._session.execute\
+                            ('SELECT hash, level, leaf FROM hash_summary'))
+        _, report = partial.intersect(queries[1], explain = True)
+        assert report['summary']['leafs'] > 0
+    finally:
+        try:
+            cfs.drop_keyspace()
+        except:
+            pass
+
+
+def test_spatial_index_summary_race(ips = ['10.2.2.2'], backend = BACKEND):
+    try:
+        cfs = Cassandra_Spatial_Index\
+            (cluster_ips = ips, backend = backend,
+             keyspace = 'test_spatial_index_summary_race',
+             summary = True)
+        other = Cassandra_Spatial_Index\
+            (cluster_ips = ips, backend = backend,
+             keyspace = 'test_spatial_index_summary_race',
+             summary = True)
+        polygon = [(0.1,0.1),(0.1,0.2),(0.2,0.2),(0.2,0.1)]
+        old = {'file': 'old', 'polygon': polygon}
+        new = {'file': 'new', 'polygon': polygon}
+        cfs.insert(old)
+
+        class Racing:
+            # the other instance inserts to the same leaf cell right
+            # after the prune has checked the cell for data
+            def __init__(self, session):
+                self._session = session
+                self.raced = False
+
+            def __getattr__(self, name):
+                return getattr(self._session, name)
+
+            def execute(self, q, *args, **kwargs):
+                res = self._session.execute(q, *args, **kwargs)
+                if not self.raced and any\
+                   (q is v for k, v in cfs._queries.items() \
+                    if k.startswith('select_hash') \
+                    and k[len('select_hash'):].isdigit()):
+                    self.raced = True
+                    res = list(res)
+                    other.insert(new)
+                return res
+
+        cfs._session = Racing(cfs._session)
+        assert cfs.delete(old)
+        assert cfs._session.raced
+        assert ['new'] == list(cfs.intersect(polygon).files())
+        assert ['new'] == list(other.intersect(polygon).files())
+    finally:
+        try:
+            cfs.drop_keyspace()
+        except:
+            pass
+
+
+def test_spatial_index_snapshot(ips = ['10.2.2.2'], backend = BACKEND):
+    tmp = tempfile.mkdtemp()
+    path = os.path.join(tmp, 'snapshot')
+    try:
+        cfs = Cassandra_Spatial_Index\
+            (cluster_ips = ips, backend = backend,
+             keyspace = 'test_spatial_index_snapshot',
+             log = True, log_shards = 3)
+        idx = dummy_index_data()
+        data = list(idx.iterate())
+        for x in data[:-1]:
+            cfs.insert(x)
+
+        snapshot = cfs.export(path, splits = 8)
+        assert os.path.islink(path)
+        assert set(idx.files()) - {data[-1]['file']} \
+            == set(snapshot.files())
+
+        query = [(0,0),(0,1),(1,1),(1,0)]
+        moved = dict(data[1])
+        moved['polygon'] = [(10,10),(10,11),(11,11),(11,10)]
+        cfs.update(data[1], moved)
+        cfs.delete(data[0])
+        cfs.insert(data[-1])
+
+        try:
+            Cassandra_Spatial_Index\
+                (cluster_ips = ips, backend = backend,
+                 keyspace = 'test_spatial_index_snapshot').refresh(path)
+            assert False
+        except RuntimeError:
+            pass
+
+        snapshot = cfs.refresh(path)
+        assert set(idx.files()) - {data[0]['file']} \
+            == set(snapshot.files())
+        assert set(cfs.intersect(query).files()) \
+            == set(snapshot.intersect(query).files())
+        assert [moved['file']] \
+            == list(snapshot.intersect(moved['polygon']).files())
+
+        # of two data of a file, refresh keeps the same as export
+        dups = [dict(data[2], polygon = [(20+i,20),(20+i,21),
+                                         (21+i,21),(21+i,20)]) \
+                for i in range(2)]
+        for x in dups:
+            cfs.insert(x)
+        snapshot = cfs.refresh(path)
+        full = cfs.export(os.path.join(tmp, 'full'), splits = 8)
+        where = [(20,20),(20,21),(23,21),(23,20)]
+        assert 1 == len(list(snapshot.intersect(where).files()))
+        assert snapshot.intersect(where).size() \
+            == full.intersect(where).size()
+        inside = [[(20.4+i,20.4),(20.4+i,20.6),(20.6+i,20.6),(20.6+i,20.4)] \
+                  for i in range(2)]
+        shown = [snapshot.intersect(x).size() for x in inside]
+        assert shown == [full.intersect(x).size() for x in inside]
+        assert [0, 1] == sorted(shown)
+
+        # a shadowed data replaces a deleted one
+        cfs.delete(dups[shown.index(1)])
+        snapshot = cfs.refresh(path)
+        full = cfs.export(os.path.join(tmp, 'full'), splits = 8)
+        inside += [query]
+        shown = [set(snapshot.intersect(x).files()) for x in inside]
+        assert shown == [set(full.intersect(x).files()) for x in inside]
+        assert data[2]['file'] in set.union(*shown)
+
+        # only the current versions are kept
+        assert 2 == len([x for x in os.listdir(tmp) \
+                         if not os.path.islink(os.path.join(tmp, x))])
+    finally:
+        try:
+            cfs.drop_keyspace()
+        except:
+            pass
+        shutil.rmtree(tmp, ignore_errors = True)
+
+
+def test_spatial_index_load_retry(ips = ['10.2.2.2'], backend = BACKEND):
+    try:
+        cfs = Cassandra_Spatial_Index\
+            (cluster_ips = ips, backend = backend,
+             keyspace = 'test_spatial_index_load_retry',
+             load_concurrency = 2, load_backoff = 0.001)
+        idx = dummy_index_data()
+        for x in idx.iterate():
+            cfs.insert(x)
+        query = [(0,0),(0,1),(1,1),(1,0)]
+        size = cfs.intersect(query).size()
+
+        class Failed:
+            def result(self):
+                raise OperationTimedOut()
+
+        class Flaky:
+            # every other data request times out once. Only this
+            # instance uses the wrapper, the session is shared
+            def __init__(self, session):
+                self._session = session
+                self._calls = []
+
+            def __getattr__(self, name):
+                return getattr(self._session, name)
+
+            def execute_async(self, q, params, *args, **kwargs):
+                self._calls.append(params)
+                if q is cfs._queries['select_data_one'] \
+                   and self._calls.count(params) == 1 \
+                   and len(self._calls) % 2:
+                    return Failed()
+                return self._session.execute_async\
+                    (q, params, *args, **kwargs)
+
+        session = cfs._session
+        cfs._session = Flaky(session)
+        assert size == cfs.intersect(query).size()
+        assert len(cfs._session._calls) > size
+
+        class Page:
+            def __init__(self, rows, state):
+                self.current_rows = rows
+                self.paging_state = state
+
+            def result(self):
+                return self
+
+        class Paged:
+            # token range scans return pages of two rows, every page
+            # after the first one times out once
+            def __init__(self, session):
+                self._session = session
+                self._failed = set()
+
+            def __getattr__(self, name):
+                return getattr(self._session, name)
+
+            def execute_async(self, q, params, paging_state = None):
+                rows = self._session.execute_async(q, params).result()
+                if q is not cfs._queries['select_data_range']:
+                    return Page(rows, None)
+
+                key = (tuple(params), paging_state)
+                if paging_state is not None and key not in self._failed:
+                    self._failed.add(key)
+                    return Failed()
+                pos = paging_state or 0
+                more = pos + 2 < len(rows)
+                return Page(rows[pos:pos + 2], pos + 2 if more else None)
+
+        cfs._session = Paged(session)
+        path = tempfile.mkdtemp()
+        try:
+            assert set(idx.files()) \
+                == set(cfs.export(os.path.join(path, 'snapshot'),
+                                  splits = 2).files())
+            assert len(cfs._session._failed) > 0
+        finally:
+            shutil.rmtree(path, ignore_errors = True)
+    finally:
+        try:
+            cfs.drop_keyspace()
+        except:
+            pass
+
+
 if __name__ == '__main__':
     test_spatial_index()
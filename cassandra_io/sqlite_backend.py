@@ -0,0 +1,417 @@
+import re
+import time
+import zlib
+import sqlite3
+import threading
+
+from collections import namedtuple
+
+
+def _token(key):
+    return zlib.crc32(str(key).encode('utf-8')) - 2**31
+
+
+def _split_top(s):
+    # split on commas outside of parentheses
+    res, depth, cur = [], 0, ''
+    for c in s:
+        if c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+        if c == ',' and depth == 0:
+            res += [cur]
+            cur = ''
+        else:
+            cur += c
+    res += [cur]
+    return [x.strip() for x in res if x.strip()]
+
+
+_ROW_TYPES = {}
+
+
+def _row_type(description):
+    names = tuple(re.sub(r'\W', '_', x[0].lower()).strip('_') \
+                  if not x[0].lower().startswith('count(') else 'count'
+                  for x in description)
+    if names not in _ROW_TYPES:
+        _ROW_TYPES[names] = namedtuple('Row', names, rename = True)
+
+    return _ROW_TYPES[names]
+
+
+class Result(list):
+    """Rows of a query
+
+    All rows are in one page.
+
+    """
+
+    paging_state = None
+
+    @property
+    def current_rows(self):
+        return self
+
+
+    def one(self):
+        return self[0] if len(self) else None
+
+
+class Future:
+    """Result of execute_async
+
+    The query is executed on first use of the future.
+
+    """
+
+    def __init__(self, fun):
+        self._fun = fun
+        self._res, self._exc = None, None
+
+
+    def _run(self):
+        if self._fun is None:
+            return
+
+        try:
+            self._res = self._fun()
+        except Exception as e:
+            self._exc = e
+        self._fun = None
+
+
+    def result(self):
+        self._run()
+        if self._exc is not None:
+            raise self._exc
+        return self._res
+
+
+    def add_callbacks(self, callback, errback,
+                      callback_args = (), errback_args = ()):
+        self._run()
+        if self._exc is not None:
+            errback(self._exc, *errback_args)
+        else:
+            callback(self._res, *callback_args)
+
+
+class Prepared:
+
+    def __init__(self, query):
+        self.query_string = query
+
+
+class Table:
+
+    def __init__(self, name, columns, pk):
+        self.name = name
+        self.columns = columns
+        self.pk = pk
+        # True after the first write with a TTL
+        self.expiring = False
+
+
+class Keyspace:
+
+    def __init__(self):
+        self.tables = {}
+        self.db = sqlite3.connect(':memory:', check_same_thread = False)
+        self.db.create_function('token', 1, _token)
+
+
+class Metadata:
+
+    def __init__(self):
+        self.keyspaces = {}
+
+
+class Cluster:
+
+    def __init__(self, *args, **kwargs):
+        """An in-process cluster with tables kept in SQLite
+
+        Supports the subset of CQL used by this package, with the
+        same results as the driver: prepared statements, 'in ?' with
+        sequences, lightweight transactions, counters and cluster
+        metadata of keyspaces and tables. Clustering order is the
+        order of primary key columns. TTLs apply to whole rows: a row
+        expires with the TTL of its last insert or update with a
+        TTL, an insert without a TTL keeps the row. Queries are
+        serialised.
+
+        Arguments are accepted for compatibility with
+        cassandra.cluster.Cluster and ignored.
+
+        """
+        self.metadata = Metadata()
+        self._lock = threading.RLock()
+
+
+    def connect(self, keyspace = None):
+        if keyspace is not None \
+           and keyspace not in self.metadata.keyspaces:
+            raise RuntimeError("keyspace %s does not exist" % keyspace)
+
+        return Session(self, keyspace)
+
+
+    def shutdown(self):
+        pass
+
+
+class Session:
+
+    def __init__(self, cluster, keyspace):
+        self.cluster = cluster
+        self.keyspace = keyspace
+        self.default_timeout = 10
+        self.is_shutdown = False
+        self._listeners = []
+
+
+    def shutdown(self):
+        self.is_shutdown = True
+
+
+    def prepare(self, query):
+        return Prepared(query)
+
+
+    def add_request_init_listener(self, fun, *args, **kwargs):
+        self._listeners += [(fun, args, kwargs)]
+
+
+    def execute_async(self, query, parameters = None, **kwargs):
+        res = Future(lambda: self._run(query, parameters))
+        for fun, args, kw in self._listeners:
+            fun(res, *args, **kw)
+        return res
+
+
+    def execute(self, query, parameters = None, **kwargs):
+        return self.execute_async(query, parameters).result()
+
+
+    def _run(self, query, parameters):
+        if isinstance(query, Prepared):
+            query = query.query_string
+        else:
+            query = query.replace('%s', '?')
+
+        query = ' '.join(query.split())
+        parameters = list(parameters) if parameters is not None else []
+        with self.cluster._lock:
+            return self._execute(query, parameters)
+
+
+    def _keyspace(self, name):
+        if name not in self.cluster.metadata.keyspaces:
+            raise RuntimeError("keyspace %s does not exist" % name)
+
+        return self.cluster.metadata.keyspaces[name]
+
+
+    def _execute(self, q, params):
+        keyspaces = self.cluster.metadata.keyspaces
+
+        m = re.match(r'CREATE KEYSPACE IF NOT EXISTS (\w+)', q, re.I)
+        if m:
+            keyspaces.setdefault(m.group(1), Keyspace())
+            return Result()
+
+        m = re.match(r'DROP KEYSPACE (\w+)', q, re.I)
+        if m:
+            keyspaces.pop(m.group(1)).db.close()
+            return Result()
+
+        # a table name qualified with a keyspace, as in CQL
+        keyspace = self.keyspace
+        m = re.search(r'\b(?:FROM|INTO|UPDATE|TABLE(?: IF NOT EXISTS)?) '
+                      r'(\w+)\.\w', q, re.I)
+        if m:
+            keyspace = m.group(1)
+            q = q[:m.start(1)] + q[m.end(1) + 1:]
+        ks = self._keyspace(keyspace)
+
+        m = re.match(r'CREATE TABLE IF NOT EXISTS (\w+) \((.*)\)'
+                     r'( WITH .*)?$', q, re.I)
+        if m:
+            return self._create_table(ks, m.group(1), m.group(2))
+
+        m = re.match(r'ALTER TABLE (\w+) ADD (\w+) (\w+)$', q, re.I)
+        if m:
+            ks.tables[m.group(1)].columns[m.group(2)] = m.group(3)
+            ks.db.execute('ALTER TABLE %s ADD COLUMN %s %s' % m.groups())
+            return Result()
+
+        q, params = self._expand_in(q, params)
+
+        m = re.match(r'INSERT INTO (\w+) \((.*?)\) VALUES \((.*?)\)'
+                     r'( IF NOT EXISTS)?( USING TTL \S+)?$', q, re.I)
+        if m:
+            return self._insert(ks.tables[m.group(1)], ks.db,
+                                m.group(2), m.group(3),
+                                m.group(5), m.group(4), params)
+
+        m = re.match(r'UPDATE (\w+)( USING TTL \S+)? SET (.*) '
+                     r'WHERE (.*?)( IF EXISTS)?$', q, re.I)
+        if m:
+            return self._update(ks.tables[m.group(1)], ks.db,
+                                m.group(2), m.group(3), m.group(4),
+                                params)
+
+        m = re.match(r'DELETE FROM (\w+) WHERE (.*?)( IF EXISTS)?$',
+                     q, re.I)
+        if m:
+            self._expire(ks.tables[m.group(1)], ks.db)
+            cur = ks.db.execute('DELETE FROM %s WHERE %s' \
+                                % m.groups()[:2], params)
+            if m.group(3):
+                return Result([(cur.rowcount > 0,)])
+            return Result()
+
+        m = re.match(r'SELECT .* FROM (\w+)', q, re.I)
+        if m:
+            return self._select(ks.tables[m.group(1)], ks.db, q, params)
+
+        raise RuntimeError("unsupported query: %s" % q)
+
+
+    def _create_table(self, ks, name, definition):
+        if name in ks.tables:
+            return Result()
+
+        columns, pk, counters = {}, [], []
+        for part in _split_top(definition):
+            m = re.match(r'PRIMARY KEY ?\((.*)\)$', part, re.I)
+            if m:
+                pk = [x.strip() for x in m.group(1)\
+                      .replace('(', '').replace(')', '').split(',')]
+                continue
+            column, kind = part.split()[:2]
+            columns[column] = kind
+            if kind.lower() == 'counter':
+                counters += [column]
+
+        ks.tables[name] = Table(name, columns, pk)
+        ks.db.execute\
+            ('CREATE TABLE %s (%s, _expires REAL, PRIMARY KEY(%s))' \
+             % (name,
+                ', '.join('%s %s' % (c, 'INTEGER DEFAULT 0' \
+                                     if c in counters else t) \
+                          for c, t in columns.items()),
+                ', '.join(pk)))
+        return Result()
+
+
+    def _expire(self, table, db):
+        # expired rows are removed before a table is used
+        if table.expiring:
+            db.execute('DELETE FROM %s WHERE _expires <= ?' \
+                       % table.name, [time.time()])
+
+
+    def _expiry(self, table, ttl, params):
+        """Expiry time of a row
+
+        :ttl: ' USING TTL <value>' part of the query or None
+
+        :params: parameters of the query, a bound TTL is the last one
+
+        :return: (expiry time or None, parameters without the TTL)
+        """
+        if not ttl:
+            return None, params
+
+        value = ttl.split()[-1]
+        if value == '?':
+            value, params = params[-1], params[:-1]
+        value = int(value)
+        if not value:
+            return None, params
+
+        table.expiring = True
+        return time.time() + value, params
+
+
+    def _insert(self, table, db, columns, values, ttl, lwt, params):
+        columns = [x.strip() for x in columns.split(',')]
+        expires, params = self._expiry(table, ttl, params)
+        self._expire(table, db)
+        columns += ['_expires']
+        values += ', ?'
+        params = list(params) + [expires]
+
+        if lwt:
+            cur = db.execute('INSERT OR IGNORE INTO %s (%s) VALUES (%s)' \
+                             % (table.name, ', '.join(columns), values),
+                             params)
+            return Result([(cur.rowcount == 1,)])
+
+        # upsert, as in cassandra
+        update = [x for x in columns if x not in table.pk]
+        sql = 'INSERT INTO %s (%s) VALUES (%s) ON CONFLICT(%s) DO ' \
+            % (table.name, ', '.join(columns), values,
+               ', '.join(table.pk))
+        sql += 'UPDATE SET ' + ', '.join('%s=excluded.%s' % (x, x) \
+                                         for x in update)
+        db.execute(sql, params)
+        return Result()
+
+
+    def _update(self, table, db, ttl, assignments, where, params):
+        # a bound TTL precedes SET, it is the first parameter
+        expires, _ = self._expiry(table, ttl, params[:1])
+        if ttl and '?' in ttl:
+            params = params[1:]
+        self._expire(table, db)
+
+        # rows are created by updates, as in cassandra
+        keys = re.findall(r'(\w+) ?= ?\?', where)
+        db.execute('INSERT OR IGNORE INTO %s (%s) VALUES (%s)' \
+                   % (table.name, ', '.join(keys),
+                      ', '.join('?' * len(keys))),
+                   params[assignments.count('?'):])
+        if expires is not None:
+            assignments += ', _expires = %r' % expires
+        db.execute('UPDATE %s SET %s WHERE %s' \
+                   % (table.name, assignments, where), params)
+        return Result()
+
+
+    def _select(self, table, db, q, params):
+        # rows are ordered by primary key, similar to clustering order
+        if 'ORDER BY' not in q.upper() and 'COUNT(' not in q.upper():
+            m = re.search(r' LIMIT \S+$', q, re.I)
+            order = ' ORDER BY ' + ', '.join(table.pk)
+            if m:
+                q = q[:m.start()] + order + q[m.start():]
+            else:
+                q += order
+
+        self._expire(table, db)
+        cur = db.execute(q, params)
+        row = _row_type(cur.description)
+        return Result(row(*x) for x in cur.fetchall())
+
+
+    def _expand_in(self, q, params):
+        # sequences bound to 'in ?' are expanded to (?, ..., ?)
+        parts = q.split('?')
+        res_q, res_p = parts[0], []
+        for i, p in enumerate(params):
+            if re.search(r' IN $', res_q, re.I) \
+               and isinstance(p, (list, tuple, set, frozenset)):
+                p = list(p)
+                res_q += '(' + ','.join('?' * len(p)) + ')' \
+                    if p else '(NULL)'
+                res_p += p
+            else:
+                res_q += '?'
+                res_p += [p]
+            res_q += parts[i + 1]
+
+        return res_q, res_p
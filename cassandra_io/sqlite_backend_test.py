@@ -0,0 +1,45 @@
+from cassandra.query import ValueSequence
+
+from cassandra_io.sqlite_backend import Cluster
+
+
+def test_sqlite_backend():
+    cluster = Cluster()
+    cluster.connect().execute("""
+    CREATE KEYSPACE IF NOT EXISTS test
+    WITH REPLICATION = {'class': 'SimpleStrategy'}""")
+    session = cluster.connect('test')
+    session.execute("""
+    CREATE TABLE IF NOT EXISTS x
+    (key text, pos int, value blob, PRIMARY KEY(key, pos))""")
+    session.execute("""
+    CREATE TABLE IF NOT EXISTS stats
+    (key text, count counter, PRIMARY KEY(key))""")
+    assert 'value' in cluster.metadata.keyspaces['test']\
+        .tables['x'].columns
+
+    insert = session.prepare("""
+    INSERT INTO x (key, pos, value) VALUES (?, ?, ?) IF NOT EXISTS""")
+    assert session.execute(insert, ['a', 1, b'1']).one()[0]
+    assert not session.execute(insert, ['a', 1, b'2']).one()[0]
+    session.execute("INSERT INTO x (key, pos, value) VALUES (%s, %s, %s)",
+                    ['a', 0, b'0'])
+    session.execute("INSERT INTO x (key, pos, value) VALUES (%s, %s, %s)",
+                    ['b', 0, b'3'])
+
+    select = session.prepare("""
+    SELECT pos, value FROM x WHERE key in ?""")
+    res = session.execute(select, [ValueSequence(['a'])])
+    assert [0, 1] == [x.pos for x in res]
+    assert b'1' == res[1].value
+    assert 3 == len(session.execute(select, [['a', 'b']]))
+    assert 0 == len(session.execute(select, [[]]))
+
+    update = session.prepare("""
+    UPDATE stats SET count = count + ? WHERE key=?""")
+    session.execute(update, [2, 'a'])
+    session.execute(update, [-1, 'a'])
+    assert 1 == session.execute("SELECT count FROM stats").one().count
+
+    session.execute("DELETE FROM x WHERE key=%s", ['a'])
+    assert 1 == session.execute("SELECT count(*) FROM x").one().count
@@ -1,11 +1,17 @@
 import os
+import json
+import struct
 import geohash
+import shapely
 import hashlib
 import itertools
+import threading
+import time
 
 import numpy as np
 
 from io import BytesIO
+from collections import OrderedDict
 
 
 def read_by_chunks(fname, chunk = 1048576):
@@ -80,9 +86,12 @@ def touch(fname, size = 10485760):
         f.write(b'\0')
 
 
-def touch_random(fname, size = 10485760):
+def touch_random(fname, size = 10485760, chunk = 1048576):
+    # written by chunks, large files are not held in memory
     with open(fname, 'wb') as f:
-        f.write(os.urandom(size))
+        while size > 0:
+            f.write(os.urandom(min(chunk, size)))
+            size -= chunk
 
 
 def get_hash(data):
@@ -92,8 +101,10 @@ def get_hash(data):
 
 
 def file_hash(fn):
-    with open(fn,'rb') as f:
-        return get_hash(f.read())
+    h = hashlib.sha512()
+    for data in read_by_chunks(fn):
+        h.update(data)
+    return h.hexdigest()
 
 
 def remove_file(fn):
@@ -137,3 +148,188 @@ def bboxes2hash(bbox_list, hash_length):
               hash_length = hash_length))
 
     return list(res)
+
+
+def hash2box(hashes, lon_first = True):
+    """Geohash cells as shapely boxes
+
+    :hashes: list of geohash strings
+
+    :lon_first: if True, boxes have longitude as the x coordinate
+
+    :return: numpy array of shapely polygons
+    """
+    res = np.array([[x['s'],x['w'],x['n'],x['e']] \
+                    for x in (geohash.bbox(h) for h in hashes)],
+                   dtype = float).reshape(-1, 4)
+
+    if lon_first:
+        res = res[:,[1,0,3,2]]
+
+    return shapely.box(res[:,0], res[:,1], res[:,2], res[:,3])
+
+
+def hashes_intersect(hashes, geom, lon_first = True):
+    """Select geohash cells that intersect with a geometry
+
+    :hashes: iterable of geohash strings
+
+    :geom: shapely geometry. It is prepared in place
+
+    :lon_first: coordinate order of the geometry
+
+    :return: list of hashes
+    """
+    hashes = list(hashes)
+    if not hashes:
+        return hashes
+
+    shapely.prepare(geom)
+    mask = shapely.intersects(geom, hash2box(hashes, lon_first))
+    return [h for h, m in zip(hashes, mask) if m]
+
+
+# magic, dtype char, number of points, point dimension, padding to
+# keep the coordinate array 8-byte aligned
+_PACKED_HEADER = struct.Struct('<3scII4x')
+_PACKED_MAGIC = b'CIO'
+
+
+def json_default(obj):
+    """Default for json.dumps that serialises numpy arrays as lists
+
+    """
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+
+    raise TypeError("Object of type %s is not JSON serializable" \
+                    % type(obj).__name__)
+
+
+def is_packed(blob):
+    """Check if blob is produced by pack_data
+
+    """
+    return isinstance(blob, (bytes, bytearray, memoryview)) \
+        and bytes(blob[:len(_PACKED_MAGIC)]) == _PACKED_MAGIC
+
+
+def pack_data(data, dtype = 'float64', key = 'polygon'):
+    """Pack a data dictionary into a compact binary blob
+
+    Coordinates under 'key' are stored as a packed array, the
+    remaining fields are stored as json text.
+
+    :data: dictionary with a list of coordinate tuples under 'key'
+
+    :dtype: 'float64' or 'float32'. Note that float32 is lossy
+    (about 1e-5 degree accuracy)
+
+    :key: name of the coordinates field
+
+    :return: bytes
+    """
+    coords = np.ascontiguousarray(data[key], dtype = dtype)
+    if 2 != len(coords.shape):
+        raise RuntimeError("'%s' must be a list of coordinate tuples" \
+                           % key)
+
+    # coordinates are replaced by a placeholder, that keeps the
+    # order of keys intact
+    attrs = dict(data)
+    attrs[key] = None
+    attrs = json.dumps(attrs, default = json_default)
+
+    return _PACKED_HEADER.pack\
+        (_PACKED_MAGIC, coords.dtype.char.encode('ascii'),
+         coords.shape[0], coords.shape[1]) \
+         + coords.tobytes() + attrs.encode('utf-8')
+
+
+def unpack_data(blob, key = 'polygon'):
+    """Unpack a blob produced by pack_data
+
+    Coordinates are returned as a list of coordinate lists, as in
+    data decoded from json text.
+
+    :blob: bytes
+
+    :key: name of the coordinates field
+
+    :return: dictionary
+    """
+    magic, dtype, n, dim = _PACKED_HEADER.unpack_from(blob)
+    if magic != _PACKED_MAGIC:
+        raise RuntimeError("blob is not packed with pack_data")
+
+    dtype = np.dtype(dtype.decode('ascii'))
+    coords = np.frombuffer(blob, dtype = dtype, count = n*dim,
+                           offset = _PACKED_HEADER.size)\
+                           .reshape(n, dim)
+
+    res = json.loads(bytes(blob[_PACKED_HEADER.size + \
+                                coords.nbytes:]).decode('utf-8'))
+    res[key] = coords.tolist()
+    return res
+
+
+class LRU_Cache:
+    """Thread-safe size-bounded least recently used cache
+
+    Entries older than 'ttl' seconds are treated as missing.
+
+    """
+
+    def __init__(self, maxsize = 1024, ttl = None):
+        """
+        :maxsize: maximum number of entries. None for no limit
+
+        :ttl: time to live of an entry in seconds. None for no expiry
+
+        """
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+
+    def get(self, key, default = None):
+        with self._lock:
+            if key not in self._data:
+                return default
+
+            value, expires = self._data[key]
+            if expires is not None and expires < time.monotonic():
+                del self._data[key]
+                return default
+
+            self._data.move_to_end(key)
+            return value
+
+
+    def put(self, key, value):
+        expires = None
+        if self._ttl is not None:
+            expires = time.monotonic() + self._ttl
+
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+
+            while self._maxsize is not None \
+                  and len(self._data) > self._maxsize:
+                self._data.popitem(last = False)
+
+
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+    def __len__(self):
+        return len(self._data)
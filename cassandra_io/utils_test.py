@@ -1,3 +1,6 @@
+import os
+import json
+import time
 import geohash
 from shapely import geometry
 import numpy as np
@@ -7,11 +10,16 @@ from cassandra_io.utils import \
     get_hash, file_hash, \
     remove_file, \
     read_by_chunks, write_by_chunks, write_bytesio_by_chunk, \
-    bbox2hash
+    bbox2hash, hashes_intersect, \
+    pack_data, unpack_data, is_packed, \
+    LRU_Cache
 
 
 def test_read_write_chunks():
     try:
+        touch_random('dummy', 2500, chunk = 1000)
+        assert 2500 == os.path.getsize('dummy')
+
         touch_random('dummy')
         h_original = file_hash('dummy')
 
@@ -84,3 +92,67 @@ def test_bbox2hash():
         bbox2hash_one([a,b,a+0.01,b+0.01],5)
         bbox2hash_one([a,b,a+0.1,b+0.1],4)
         bbox2hash_one([a,b,a+0.1,b+0.1],3)
+
+
+def test_pack_data():
+    data = {'file': 'one',
+            'polygon': [(0.1,0.2),(0.1,1),(1,1),(1,0.2)],
+            'meta': {'year': 2020}}
+
+    blob = pack_data(data)
+    assert is_packed(blob)
+    assert not is_packed('{"file": "one"}')
+    res = unpack_data(blob)
+    assert list(res.keys()) == list(data.keys())
+    assert res['meta'] == data['meta']
+    # same as data stored as json text
+    assert res == json.loads(json.dumps(data))
+
+    blob32 = pack_data(data, dtype = 'float32')
+    assert len(blob32) < len(blob)
+    res = unpack_data(blob32)
+    assert np.allclose(res['polygon'], np.array(data['polygon']))
+
+
+def test_lru_cache():
+    cache = LRU_Cache(maxsize = 2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert 1 == cache.get('a')
+    cache.put('c', 3)
+    assert 2 == len(cache)
+    assert cache.get('b') is None
+    assert 1 == cache.get('a')
+    cache.pop('a')
+    assert cache.get('a') is None
+
+    cache = LRU_Cache(maxsize = 2, ttl = 0.01)
+    cache.put('a', [])
+    assert [] == cache.get('a')
+    time.sleep(0.02)
+    assert cache.get('a', 'missing') == 'missing'
+
+
+def test_hashes_intersect():
+    # a thin diagonal strip, (lon, lat) coordinates
+    strip = geometry.Polygon([(0,0),(0.1,0),(10,9.9),
+                              (10,10),(9.9,10),(0,0.1)])
+    bbox = [0,0,10,10]
+
+    for length in (2,3,4):
+        hashes = bbox2hash(bbox, length)
+        res = hashes_intersect(hashes, strip)
+        assert len(res) < len(hashes)
+
+        # a cell is kept iff it intersects the strip
+        for h in hashes:
+            x = geohash.bbox(h)
+            box = geometry.box(x['w'],x['s'],x['e'],x['n'])
+            assert (h in res) == box.intersects(strip)
+
+    lat_first = geometry.Polygon([(y,x) for x,y in \
+                                  strip.exterior.coords])
+    assert set(hashes_intersect(bbox2hash(bbox, 3), strip)) == \
+        set(hashes_intersect(bbox2hash(bbox, 3), lat_first,
+                             lon_first = False))
+    assert [] == hashes_intersect([], strip)
@@ -0,0 +1,84 @@
+#!/bin/env python3
+
+import time
+import argparse
+
+import numpy as np
+
+from shapely import geometry
+
+from cassandra_io.polygon_index \
+    import Polygon_File_Index
+
+
+def random_data(n, seed = 0):
+    """Generate n random polygons in a [0,1000]^2 square
+
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.uniform(0, 1000, size = (n, 2))
+    radius = rng.uniform(0.5, 2, size = n)
+    angles = np.linspace(0, 2*np.pi, 9)[:-1]
+
+    for i, ((x, y), r) in enumerate(zip(centers, radius)):
+        yield {'file': 'file_%d' % i,
+               'polygon': list(zip((x + r*np.cos(angles)).tolist(),
+                                   (y + r*np.sin(angles)).tolist()))}
+
+
+def intersect_loop(idx, polygon):
+    """Reference: one shapely call per candidate
+
+    """
+    polygon = geometry.Polygon(polygon)
+    res = []
+    for pos in idx._rtree.intersection(polygon.bounds):
+        schnitt = polygon.intersection(idx._geometry(pos))
+        if schnitt.is_empty \
+           or not isinstance(schnitt, geometry.Polygon):
+            continue
+        new_data = dict(idx._records[pos])
+        new_data.update({'polygon': list(schnitt.exterior.coords)})
+        res += [new_data]
+
+    return Polygon_File_Index(res)
+
+
+def timeit(idx, fun, repeat = 3):
+    res = []
+    for _ in range(repeat):
+        # polygons are constructed in every run
+        idx._geometries.clear()
+        start = time.time()
+        fun()
+        res += [time.time() - start]
+
+    return min(res)
+
+
+def run(n, compact):
+    start = time.time()
+    idx = Polygon_File_Index(random_data(n), compact = compact)
+    print("  build: %.2f s" % (time.time() - start))
+
+    for side in (10, 100, 500):
+        query = [(100,100),(100,100+side),
+                 (100+side,100+side),(100+side,100)]
+        loop = timeit(idx, lambda: intersect_loop(idx, query))
+        vect = timeit(idx, lambda: idx.intersect(query))
+        size = idx.intersect(query).size()
+        print("  query %4d: %7d results, loop %.3f s, "
+              "vectorised %.3f s" % (side, size, loop, vect))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser\
+        (description = 'Polygon_File_Index.intersect benchmark')
+    parser.add_argument('-n', type = int, nargs = '+',
+                        default = [10**4, 10**5, 10**6])
+    args = parser.parse_args()
+
+    for n in args.n:
+        for compact in (False, True):
+            print("entries: %d, compact: %s" % (n, compact))
+            run(n, compact)
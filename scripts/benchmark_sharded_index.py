@@ -0,0 +1,77 @@
+#!/bin/env python3
+
+import time
+import shutil
+import argparse
+
+import numpy as np
+
+from cassandra_io.polygon_index \
+    import Polygon_File_Index
+from cassandra_io.sharded_index \
+    import Sharded_Polygon_Index
+
+from benchmark_polygon_index \
+    import random_data
+
+
+def timeit(fun, repeat = 3):
+    res = []
+    for _ in range(repeat):
+        start = time.time()
+        fun()
+        res += [time.time() - start]
+
+    return min(res)
+
+
+def run(path, n, processes, side, points):
+    query = [(100,100),(100,100+side),
+             (100+side,100+side),(100+side,100)]
+    points = np.random.default_rng(1).uniform(0, 1000, size = (points, 2))
+
+    idx = Polygon_File_Index(random_data(n), compact = True)
+    single = (timeit(lambda: idx.intersect(query)),
+              timeit(lambda: idx.locate_many(points,
+                                             return_indices = True)))
+    print("  single index: intersect %.3f s, locate_many %.3f s" \
+          % single)
+
+    for p in processes:
+        with Sharded_Polygon_Index(path, processes = p) as x:
+            # workers open their shards in the first call
+            x.intersect(query)
+            x.locate_many(points)
+            res = (timeit(lambda: x.intersect(query)),
+                   timeit(lambda: x.locate_many(points)))
+        print("  processes %3d: intersect %.3f s (x%.1f), "
+              "locate_many %.3f s (x%.1f)" \
+              % (p, res[0], single[0] / res[0],
+                 res[1], single[1] / res[1]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser\
+        (description = 'Sharded_Polygon_Index scaling benchmark')
+    parser.add_argument('-n', type = int, nargs = '+',
+                        default = [10**5, 10**6])
+    parser.add_argument('--processes', type = int, nargs = '+',
+                        default = [1, 2, 4, 8])
+    parser.add_argument('--shards', type = int, default = None,
+                        help = 'number of shards, default is the '
+                        'number of cores')
+    parser.add_argument('--side', type = float, default = 500,
+                        help = 'side of the intersect query')
+    parser.add_argument('--points', type = int, default = 10**5,
+                        help = 'number of locate_many points')
+    parser.add_argument('--path', default = 'benchmark_sharded_index')
+    args = parser.parse_args()
+
+    for n in args.n:
+        print("entries: %d" % n)
+        try:
+            Sharded_Polygon_Index.build(random_data(n), args.path,
+                                        shards = args.shards)
+            run(args.path, n, args.processes, args.side, args.points)
+        finally:
+            shutil.rmtree(args.path, ignore_errors = True)
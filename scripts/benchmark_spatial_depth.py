@@ -0,0 +1,115 @@
+#!/bin/env python3
+
+import time
+import argparse
+
+import numpy as np
+
+from shapely import geometry
+
+from cassandra_io.spatial_index \
+    import Cassandra_Spatial_Index
+
+
+def skewed_data(n, cities = 5, background = 0.1, size = 0.05, seed = 0):
+    """Generate small square polygons crowded around few centers
+
+    :n: number of polygons
+
+    :cities: number of dense centers
+
+    :background: share of polygons uniformly spread over Europe
+
+    :size: side of a polygon in degrees
+
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.uniform((-10, 35), (30, 60), size = (cities, 2))
+
+    res = []
+    for i in range(n):
+        if rng.random() < background:
+            lon, lat = rng.uniform((-10, 35), (30, 60))
+        else:
+            lon, lat = rng.normal(centers[rng.integers(cities)], 0.05)
+        res += [{'file': 'skewed_%d' % i,
+                 'polygon': [(lon, lat), (lon, lat + size),
+                             (lon + size, lat + size),
+                             (lon + size, lat)]}]
+
+    return res
+
+
+def partition_sizes(cfs):
+    """Number of data entries per leaf cell
+
+    """
+    res = {}
+    for level in range(cfs._hash_min, cfs._hash_max + 1):
+        counts = {}
+        for h, data_id in cfs._session.execute\
+            ('SELECT hash, data_id FROM hash%d' % level):
+            if len(data_id) == cfs._datahash_length:
+                counts[h] = counts.get(h, 0) + 1
+        res[level] = list(counts.values())
+
+    return res
+
+
+def run(cfs, data, queries):
+    start = time.time()
+    for x in data:
+        cfs.insert(x)
+    insert = len(data) / (time.time() - start)
+
+    times, candidates = [], []
+    for lon, lat in queries:
+        start = time.time()
+        bbox = [(lon, lat), (lon, lat + 0.05),
+                (lon + 0.05, lat + 0.05), (lon + 0.05, lat)]
+        candidates += [len(set(cfs._query_polygons\
+                               (geometry.MultiPolygon\
+                                ([geometry.Polygon(bbox)]), True)))]
+        cfs.intersect(bbox)
+        times += [time.time() - start]
+
+    print("  inserts: %.1f 1/s" % insert)
+    for level, sizes in partition_sizes(cfs).items():
+        if not sizes:
+            continue
+        print("  level %d: %d cells, entries per cell max %d, p99 %d" \
+              % (level, len(sizes), max(sizes),
+                 np.percentile(sizes, 99)))
+    print("  intersect: median %.4f s, max %.4f s" \
+          % (np.median(times), max(times)))
+    print("  candidates: median %d, max %d" \
+          % (np.median(candidates), max(candidates)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser\
+        (description = 'Hash depth on skewed data')
+    parser.add_argument('--ips', nargs = '+', default = ['172.17.0.2'])
+    parser.add_argument('--backend', default = 'cassandra',
+                        choices = ['cassandra', 'sqlite'])
+    parser.add_argument('-n', type = int, default = 20000)
+    parser.add_argument('--max_fanout', type = int, default = 256)
+    args = parser.parse_args()
+
+    data = skewed_data(args.n)
+    queries = [x['polygon'][0] for x in data[:200]]
+
+    for max_fanout in (None, args.max_fanout):
+        print("max_fanout: %s" % str(max_fanout))
+        try:
+            cfs = Cassandra_Spatial_Index\
+                (cluster_ips = args.ips, backend = args.backend,
+                 keyspace = 'benchmark_spatial_depth',
+                 hash_min = 2, depth = 4,
+                 max_fanout = max_fanout)
+            run(cfs, data, queries)
+        finally:
+            try:
+                cfs.drop_keyspace()
+            except:
+                pass
@@ -0,0 +1,317 @@
+#!/bin/env python3
+
+import sys
+import json
+import time
+import argparse
+import threading
+
+import numpy as np
+
+from cassandra_io.files \
+    import Cassandra_Files
+from cassandra_io.spatial_index \
+    import Cassandra_Spatial_Index
+from cassandra_io.polygon_index \
+    import Polygon_File_Index
+
+from cassandra_io.utils \
+    import touch_random, remove_file
+
+
+SIZES = {'K': 1024, 'M': 1024**2, 'G': 1024**3}
+
+
+def parse_size(x):
+    if x[-1].upper() in SIZES:
+        return int(float(x[:-1]) * SIZES[x[-1].upper()])
+    return int(x)
+
+
+def measure(fun, repeat, warmup):
+    """Time calls of fun
+
+    :fun: function of the repetition number, which is negative for
+    warm-up calls
+
+    :return: list of durations in seconds, warm-up calls excluded
+    """
+    for i in range(warmup):
+        fun(-1 - i)
+
+    res = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        fun(i)
+        res += [time.perf_counter() - start]
+
+    return res
+
+
+def summary(scenario, times, **params):
+    """Percentiles of durations
+
+    :params: scenario parameters, kept in the result. 'items' is the
+    number of items processed per duration and gives throughput.
+
+    """
+    times = np.asarray(times)
+    res = {'scenario': scenario,
+           'params': params,
+           'n': len(times),
+           'mean': float(times.mean()),
+           'p50': float(np.percentile(times, 50)),
+           'p95': float(np.percentile(times, 95)),
+           'p99': float(np.percentile(times, 99)),
+           'max': float(times.max())}
+    if 'items' in params:
+        res['throughput'] = params['items'] / res['mean']
+
+    return res
+
+
+def polygons(n, size, seed = 0):
+    """Random square polygons over Europe
+
+    :size: side in degrees
+
+    """
+    rng = np.random.default_rng(seed)
+    for i, (lon, lat) in enumerate(rng.uniform((-10, 35), (30, 60),
+                                                size = (n, 2))):
+        yield {'file': 'polygon_%d' % i,
+               'polygon': [(lon, lat), (lon, lat + size),
+                           (lon + size, lat + size), (lon + size, lat)]}
+
+
+def region(lon, lat, size):
+    return [(lon, lat), (lon, lat + size),
+            (lon + size, lat + size), (lon + size, lat)]
+
+
+def bench_files(cfs, args):
+    res = []
+    for size in args.sizes:
+        touch_random('benchmark_file', parse_size(size))
+        try:
+            times = measure(lambda i: cfs.upload('benchmark_file',
+                                                 'benchmark_file'),
+                            args.repeat, args.warmup)
+            res += [summary('files_upload', times, size = size,
+                            bytes = parse_size(size))]
+            # only the last of the repeated uploads is kept
+            cfs.cleanup()
+
+            times = measure(lambda i: cfs.download('benchmark_file',
+                                                   'benchmark_file_'),
+                            args.repeat, args.warmup)
+            res += [summary('files_download', times, size = size,
+                            bytes = parse_size(size))]
+        finally:
+            remove_file('benchmark_file')
+            remove_file('benchmark_file_')
+            cfs.delete('benchmark_file')
+
+    return res
+
+
+def bench_small_files(cfs, args):
+    names = ['small_%d' % i for i in range(args.small_count)]
+
+    touch_random('benchmark_small', parse_size(args.small_size))
+    try:
+        res = [summary('small_files_upload',
+                       measure(lambda i: cfs.upload('benchmark_small',
+                                                    names[i]),
+                               len(names), 0),
+                       size = args.small_size, items = 1),
+               summary('small_files_download',
+                       measure(lambda i: cfs.download_bytesio(names[i]),
+                               len(names), 0),
+                       size = args.small_size, items = 1)]
+    finally:
+        remove_file('benchmark_small')
+        for x in names:
+            cfs.delete(x)
+
+    return res
+
+
+def bench_concurrent(cfs, args):
+    touch_random('benchmark_small', parse_size(args.small_size))
+    try:
+        return _bench_concurrent(cfs, args)
+    finally:
+        remove_file('benchmark_small')
+
+
+def _bench_concurrent(cfs, args):
+    res = []
+    for clients in args.clients:
+        times, lock = [], threading.Lock()
+
+        def client(k):
+            local = measure\
+                (lambda i: cfs.upload('benchmark_small',
+                                      'concurrent_%d_%d' % (k, i)),
+                 args.small_count // clients, 0)
+            with lock:
+                times.extend(local)
+
+        threads = [threading.Thread(target = client, args = (k,)) \
+                   for k in range(clients)]
+        start = time.perf_counter()
+        for x in threads:
+            x.start()
+        for x in threads:
+            x.join()
+        total = time.perf_counter() - start
+
+        x = summary('concurrent_upload', times, clients = clients,
+                    size = args.small_size)
+        x['throughput'] = len(times) / total
+        res += [x]
+
+        for k in range(clients):
+            for i in range(args.small_count // clients):
+                cfs.delete('concurrent_%d_%d' % (k, i))
+
+    return res
+
+
+def bench_spatial(csi, args):
+    data = list(polygons(args.polygons, 0.05))
+    it = iter(data)
+    res = [summary('spatial_insert',
+                   measure(lambda i: csi.insert(next(it)),
+                           len(data), 0),
+                   items = 1)]
+
+    rng = np.random.default_rng(1)
+    for size in args.regions:
+        queries = rng.uniform((-10, 35), (30, 60), size = (args.repeat, 2))
+        times = measure(lambda i: csi.intersect\
+                        (region(*queries[max(i, 0)], size)),
+                        args.repeat, args.warmup)
+        res += [summary('spatial_intersect', times, region = size)]
+
+    return res
+
+
+def bench_polygon_index(args):
+    data = list(polygons(args.polygons, 0.05))
+    for i, x in enumerate(data):
+        x['year'] = 2000 + i % 20
+
+    res = [summary('polygon_index_build',
+                   measure(lambda i: Polygon_File_Index(data),
+                           args.repeat, args.warmup),
+                   items = len(data))]
+    idx = Polygon_File_Index(data)
+
+    rng = np.random.default_rng(1)
+    for size in args.regions:
+        queries = rng.uniform((-10, 35), (30, 60), size = (args.repeat, 2))
+        res += [summary('polygon_index_intersect',
+                        measure(lambda i: idx.intersect\
+                                (region(*queries[max(i, 0)], size)),
+                                args.repeat, args.warmup),
+                        region = size)]
+
+    res += [summary('polygon_index_filter',
+                    measure(lambda i: idx.filter\
+                            (where = [('year', '==', 2010)]).size(),
+                            args.repeat, args.warmup),
+                    items = len(data))]
+
+    points = rng.uniform((-10, 35), (30, 60), size = (10**5, 2))
+    res += [summary('polygon_index_locate_many',
+                    measure(lambda i: idx.locate_many\
+                            (points, return_indices = True),
+                            args.repeat, args.warmup),
+                    items = len(points))]
+
+    return res
+
+
+SCENARIOS = ['files', 'small_files', 'concurrent',
+             'spatial', 'polygon_index']
+
+
+def run(args):
+    res = []
+    scenarios = set(args.scenarios)
+
+    if scenarios & {'files', 'small_files', 'concurrent'}:
+        cfs = None
+        try:
+            cfs = Cassandra_Files\
+                (keyspace_suffix = '_benchmark',
+                 cluster_ips = args.ips, backend = args.backend)
+            if 'files' in scenarios:
+                res += bench_files(cfs, args)
+                cfs.cleanup()
+            if 'small_files' in scenarios:
+                res += bench_small_files(cfs, args)
+                cfs.cleanup()
+            if 'concurrent' in scenarios:
+                res += bench_concurrent(cfs, args)
+                cfs.cleanup()
+        finally:
+            if cfs is not None:
+                cfs.drop_keyspace()
+
+    if 'spatial' in scenarios:
+        csi = None
+        try:
+            csi = Cassandra_Spatial_Index\
+                (keyspace = 'benchmark_spatial',
+                 cluster_ips = args.ips, backend = args.backend)
+            res += bench_spatial(csi, args)
+        finally:
+            if csi is not None:
+                csi.drop_keyspace()
+
+    if 'polygon_index' in scenarios:
+        res += bench_polygon_index(args)
+
+    return {'backend': args.backend,
+            'ips': args.ips,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'repeat': args.repeat,
+            'warmup': args.warmup,
+            'results': res}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser\
+        (description = 'Benchmark suite with json output')
+    parser.add_argument('--backend', default = 'cassandra',
+                        choices = ['cassandra', 'sqlite'])
+    parser.add_argument('--ips', nargs = '+', default = ['172.17.0.2'])
+    parser.add_argument('--scenarios', nargs = '+', default = SCENARIOS,
+                        choices = SCENARIOS)
+    parser.add_argument('--repeat', type = int, default = 10)
+    parser.add_argument('--warmup', type = int, default = 1)
+    parser.add_argument('--sizes', nargs = '+',
+                        default = ['1K', '1M', '100M'],
+                        help = 'file sizes, e.g. 1K 1M 10G')
+    parser.add_argument('--small_size', default = '4K')
+    parser.add_argument('--small_count', type = int, default = 1000)
+    parser.add_argument('--clients', type = int, nargs = '+',
+                        default = [1, 4, 16])
+    parser.add_argument('--polygons', type = int, default = 10000)
+    parser.add_argument('--regions', type = float, nargs = '+',
+                        default = [0.1, 1, 5],
+                        help = 'side of query regions in degrees')
+    parser.add_argument('-o', '--output', default = None,
+                        help = 'json file, default is stdout')
+    args = parser.parse_args()
+
+    res = run(args)
+    if args.output is None:
+        json.dump(res, sys.stdout, indent = 1)
+        print()
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(res, f, indent = 1)